@@ -1,26 +1,29 @@
+import asyncio
 import logging
 import os
 import shutil
-import subprocess
-from contextlib import contextmanager
+import threading
+from functools import partial
 from pathlib import Path
-from queue import Queue
-from time import sleep
 
-import GPUtil
+import mrcfile
 
-from ._threaded import run_threaded
+from ._cache import check_up_to_date, describe_job, partial_path, write_manifest
+from ._gpu import get_gpus
+from ._threaded import Job, run_jobs, run_streamed
 
+# cuda context, fft plans and other fixed overhead
+ARETOMO_BASE_MEMORY = 1024
+# very rough seconds per unit of _estimate_cost, when there is no history yet
+# (about a minute and a half for 61 4k tilts at bin 4 on a recent gpu)
+ARETOMO_SECONDS_PER_VOXEL = 5e-9
 
-@contextmanager
-def _cd(dir):
-    prev = os.getcwd()
-    os.chdir(dir)
-    yield
-    os.chdir(prev)
 
+def _aligned_stack(output):
+    return output.with_stem(output.stem + "_aligned").with_suffix(".st")
 
-def _aretomo(
+
+async def _aretomo(
     input_,
     rawtlt,
     aln,
@@ -42,12 +45,26 @@ def _aretomo(
     cs=0,
     defocus=0,
     reconstruct=False,
-    gpu_queue=None,
+    gpu=0,
+    update=None,
+    timeout=None,
+    scratch=None,
+    staged=None,
+    stage_only=False,
     dry_run=False,
     overwrite=False,
 ):
+    """
+    Run aretomo to align or reconstruct a tilt series.
+
+    If scratch is given, the job runs in a scratch directory, which is recorded
+    in the `staged` dict together with what is needed to finish the job with
+    `_copy_back` (including writing the manifest). With `stage_only`, inputs are
+    only copied there, so the gpu does not have to wait for it later.
+    """
     log = logging.getLogger("waretomo")
-    # cwd dance is necessary cause aretomo messes up paths otherwise
+    # running from the output dir is necessary cause aretomo messes up paths otherwise
+    # (we pass cwd to subprocess instead of chdir, which is not thread-safe)
     # need to use os.path.relpath cause pathlib cannot handle non-subpath relative paths
     # https://stackoverflow.com/questions/38083555/using-pathlibs-relative-to-for-directories-on-the-same-level
     cwd = output.parent.absolute()
@@ -57,22 +74,15 @@ def _aretomo(
     xf = Path(os.path.relpath(xf, cwd))
     output = Path(os.path.relpath(output, cwd))
     if not reconstruct:
-        output = output.with_stem(output.stem + "_aligned").with_suffix(".st")
+        output = _aligned_stack(output)
     # LogFile is broken, so we do it ourselves
     aretomolog = output.with_suffix(".aretomolog")
-    with _cd(cwd):
-        if not overwrite and output.exists():
-            raise FileExistsError(output)
-
-    # only one job per gpu
-    gpu = 0 if gpu_queue is None else gpu_queue.get()
 
     options = {
         "InMrc": input_,
         "OutMrc": output,
         # 'LogFile': input_.with_suffix('.log').relative_to(cwd),  # currently broken
         "OutBin": binning,
-        "Gpu": gpu,
         "DarkTol": 0,
     }
 
@@ -108,6 +118,40 @@ def _aretomo(
         if patches is not None:
             options["Patch"] = f"{patches} {patches}"
 
+    # only rerun if inputs or parameters changed since the output was made
+    inputs = [cwd / input_, cwd / aln if reconstruct else cwd / rawtlt, roi_file]
+    description = describe_job(inputs, {"cmd": cmd, **options})
+    if not overwrite:
+        check_up_to_date(cwd / output, description)
+
+    if scratch is not None:
+        # all inputs end up next to each other, so they are passed by name
+        staged_inputs = [
+            cwd / input_,
+            cwd / (aln if reconstruct else rawtlt),
+            options.get("RoiFile"),
+        ]
+        for key in ("InMrc", "AlnFile", "AngFile", "RoiFile"):
+            if key in options:
+                options[key] = Path(options[key]).name
+        # normally done by a separate job, unless a failed attempt cleaned up
+        if stage_only or "run_dir" not in staged:
+            staged["run_dir"] = await _stage(
+                scratch,
+                staged_inputs,
+                output_size=_estimate_output_size(
+                    cwd / input_, binning, thickness_recon, reconstruct
+                ),
+            )
+        if stage_only:
+            return
+
+    options["Gpu"] = gpu
+    if reconstruct:
+        # renamed into place once complete, so a crash can't leave half a volume
+        # (aligned stacks can't be renamed: aretomo names other outputs after them)
+        options["OutMrc"] = partial_path(output)
+
     # run aretomo with basic settings
     aretomo_cmd = f"{cmd} {' '.join(f'-{k} {v}' for k, v in options.items())}"
 
@@ -116,58 +160,273 @@ def _aretomo(
         log.info(f'mv {xf} {warp_mdoc_basename + ".xf"}')
 
     if not dry_run:
-        with _cd(cwd):
-            try:
-                proc = subprocess.run(
-                    aretomo_cmd.split(), capture_output=True, check=False, cwd=cwd
-                )
-            finally:
-                aretomolog.write_bytes(proc.stdout + proc.stderr)
-                if gpu_queue is not None:
-                    gpu_queue.put(gpu)
-            proc.check_returncode()
-        if not reconstruct:
-            # move xf file so warp can see it (needs full ts name + .xf)
-            shutil.move(cwd / xf, cwd / (warp_mdoc_basename + ".xf"))
+        run_dir = cwd if scratch is None else staged["run_dir"]
+        try:
+            await run_streamed(
+                aretomo_cmd.split(),
+                cwd / aretomolog,
+                update=update,
+                timeout=timeout,
+                cwd=run_dir,
+            )
+            if reconstruct:
+                os.replace(run_dir / options["OutMrc"], run_dir / output)
+            else:
+                # move xf file so warp can see it (needs full ts name + .xf)
+                shutil.move(run_dir / xf, run_dir / (warp_mdoc_basename + ".xf"))
+        except BaseException:
+            if scratch is not None:
+                scratch.cleanup(run_dir)
+                staged.clear()
+            raise
+        if scratch is not None:
+            staged.update(
+                run_dir=run_dir,
+                dest=cwd,
+                inputs=[path.name for path in staged_inputs if path is not None],
+                output=cwd / output,
+                description=description,
+            )
+        else:
+            write_manifest(cwd / output, description)
     else:
-        sleep(0.1)
-        if gpu_queue is not None:
-            gpu_queue.put(gpu)
+        await asyncio.sleep(0.1)
 
 
-def aretomo_batch(
-    progress, tilt_series, suffix="", label="", cmd="AreTomo", gpus=None, **kwargs
+async def _stage(scratch, inputs, output_size=0):
+    """Copy inputs to scratch; waiting for space there can be cancelled."""
+    cancelled = threading.Event()
+    try:
+        # copying (and waiting for space) blocks, so it happens in a thread
+        return await asyncio.to_thread(
+            scratch.stage, inputs, output_size=output_size, cancelled=cancelled
+        )
+    except asyncio.CancelledError:
+        # otherwise the thread could wait forever, and block the exit
+        cancelled.set()
+        raise
+
+
+def _copy_back(scratch, staged, outputs):
+    """Copy the results of a job run in scratch to their final location."""
+    if not staged:
+        if all(output.exists() for output in outputs):
+            # the job did not need to run
+            raise FileExistsError
+        # e.g. staged by another worker, which died before copying them back
+        raise FileNotFoundError(f"results of the job are missing: {outputs}")
+    try:
+        scratch.copy_back(staged["run_dir"], staged["dest"], exclude=staged["inputs"])
+        write_manifest(staged["output"], staged["description"])
+    finally:
+        scratch.cleanup(staged["run_dir"])
+        staged.clear()
+
+
+def _stack_shape(stack):
+    try:
+        with mrcfile.open(stack, header_only=True, permissive=True) as mrc:
+            return int(mrc.header.nx), int(mrc.header.ny), int(mrc.header.nz)
+    except (OSError, ValueError):
+        return None
+
+
+def _estimate_memory(
+    stack,
+    binning=4,
+    thickness_align=1200,
+    thickness_recon=0,
+    patches=None,
+    reconstruct=False,
+    **kwargs,
 ):
-    log = logging.getLogger("waretomo")
+    """Very rough estimate of the gpu memory (MB) aretomo needs for a stack."""
+    if (shape := _stack_shape(stack)) is None:
+        return 0
+    nx, ny, nz = shape
+    # the raw stack and a few working copies of it live on the gpu as float32
+    stack_mb = nx * ny * nz * 4 / 2**20
+    if patches:
+        stack_mb *= 1.5
+    # plus the (binned) volume used for alignment or reconstruction
+    thickness = thickness_recon if reconstruct else thickness_align
+    volume_mb = (nx / binning) * (ny / binning) * (thickness / binning) * 4 / 2**20
+    return int(2 * stack_mb + volume_mb + ARETOMO_BASE_MEMORY)
+
+
+def _estimate_output_size(stack, binning=4, thickness_recon=0, reconstruct=False):
+    """Rough size (bytes) of what aretomo writes: an aligned stack or a volume."""
+    if (shape := _stack_shape(stack)) is None:
+        return 0
+    nx, ny, nz = shape
+    depth = (thickness_recon or nx) if reconstruct else nz * binning
+    return int(4 * (nx / binning) * (ny / binning) * (depth / binning))
+
+
+def _estimate_cost(
+    stack,
+    binning=4,
+    thickness_align=1200,
+    thickness_recon=0,
+    reconstruct=False,
+    **kwargs,
+):
+    """Relative runtime of an aretomo job: every tilt is projected into the volume."""
+    if (shape := _stack_shape(stack)) is None:
+        return 0
+    nx, ny, nz = shape
+    thickness = (thickness_recon if reconstruct else thickness_align) or nx
+    return nz * (nx / binning) * (ny / binning) * (thickness / binning)
+
+
+def _job_features(
+    stack,
+    binning=4,
+    thickness_align=1200,
+    thickness_recon=0,
+    patches=None,
+    reconstruct=False,
+    **kwargs,
+):
+    """What the runtime of an aretomo job depends on, for the runtime history."""
+    nx, ny, nz = _stack_shape(stack) or (0, 0, 0)
+    return {
+        "kind": "reconstruct" if reconstruct else "align",
+        "tilts": nz,
+        "nx": nx,
+        "ny": ny,
+        "binning": binning,
+        "patches": patches,
+        "volz": thickness_recon if reconstruct else thickness_align,
+    }
+
+
+def _predict_runtime(history, features, work):
+    """Runtime (seconds) from the history if possible, or from the size otherwise."""
+    if history is not None:
+        runtime = history.predict(features, work)
+        if runtime is not None:
+            return runtime
+    return work * ARETOMO_SECONDS_PER_VOXEL
+
+
+def aretomo_jobs(
+    tilt_series,
+    suffix="",
+    label="",
+    cmd="AreTomo",
+    reconstruct=False,
+    output=None,
+    scratch=None,
+    history=None,
+    **kwargs,
+):
+    """
+    Make one gpu job per tilt series running aretomo.
+
+    Reconstructions are written to the path in `ts[output]` (by default, the
+    "recon" key with the same suffix as the input stack).
+
+    Jobs are given a predicted runtime as cost, based on the RuntimeHistory
+    if given, and the features to record in it once they ran.
+
+    If scratch is given, each gpu job is preceded by a cpu job copying its
+    inputs to scratch and followed by one copying its results back, so the gpu
+    is free to run other jobs in the meantime. Other jobs should depend on the
+    last job with a given name, and dependencies should be added to all of them.
+    """
     if not shutil.which(cmd):
         raise FileNotFoundError(f"{cmd} is not available on the system")
-    if gpus is None:
-        gpus = [gpu.id for gpu in GPUtil.getGPUs()]
-    if not gpus:
-        raise RuntimeError("you need at least one GPU to run AreTomo")
-    log.info(f"Running AreTomo in parallel on {len(gpus)} GPUs.")
+    if kwargs.get("dry_run"):
+        scratch = None
+    output = output or "recon" + suffix
 
-    # use a queue to hold gpu ids to ensure we only run one job per gpu
-    gpu_queue = Queue()
-    for gpu in gpus:
-        gpu_queue.put(gpu)
-
-    partials = []
+    jobs = []
     for ts in tilt_series:
-        partials.append(
-            lambda ts=ts: _aretomo(
-                input_=ts["stack" + suffix],
-                rawtlt=ts["rawtlt"],
-                aln=ts["aln"],
-                xf=ts["xf"],
-                roi_file=ts["roi"],
-                output=ts["recon" + suffix],
-                gpu_queue=gpu_queue,
-                cmd=cmd,
-                warp_mdoc_basename=ts["mdoc"].stem,
-                **ts["aretomo_kwargs"],
-                **kwargs,
+        staged = {}
+        features = _job_features(ts["stack"], reconstruct=reconstruct, **kwargs)
+        work = _estimate_cost(ts["stack"], reconstruct=reconstruct, **kwargs)
+        fn = partial(
+            _aretomo,
+            input_=ts["stack" + suffix],
+            rawtlt=ts["rawtlt"],
+            aln=ts["aln"],
+            xf=ts["xf"],
+            roi_file=ts["roi"],
+            output=ts[output],
+            cmd=cmd,
+            warp_mdoc_basename=ts["mdoc"].stem,
+            reconstruct=reconstruct,
+            scratch=scratch,
+            staged=staged,
+            **ts["aretomo_kwargs"],
+            **kwargs,
+        )
+        inputs = [
+            ts["stack" + suffix],
+            ts["aln"] if reconstruct else ts["rawtlt"],
+            ts["roi"],
+        ]
+        stage = None
+        if scratch is not None:
+            stage = Job(
+                partial(fn, stage_only=True),
+                label=f"{label}: staging inputs",
+                name=ts["name"],
+                inputs=inputs,
             )
+            jobs.append(stage)
+        job = Job(
+            fn,
+            label=label,
+            name=ts["name"],
+            gpu=True,
+            track=True,
+            mem=_estimate_memory(ts["stack"], reconstruct=reconstruct, **kwargs),
+            cost=_predict_runtime(history, features, work),
+            features=features,
+            work=work,
+            deps=[stage],
+            inputs=inputs,
+            outputs=(
+                [ts[output]]
+                if reconstruct
+                else [_aligned_stack(ts["recon"]), ts["aln"]]
+            ),
+            # staged inputs only exist on the node which copied them
+            pinned_to=stage,
         )
+        jobs.append(job)
+        if scratch is not None:
+            jobs.append(
+                Job(
+                    lambda staged=staged, outputs=job.outputs: _copy_back(
+                        scratch, staged, outputs
+                    ),
+                    label=f"{label}: copying back results",
+                    name=ts["name"],
+                    deps=[job],
+                    outputs=job.outputs,
+                    pinned_to=job,
+                )
+            )
+    return jobs
+
+
+def aretomo_batch(
+    progress,
+    tilt_series,
+    suffix="",
+    label="",
+    cmd="AreTomo",
+    gpus=None,
+    gpu_slots=1,
+    retries=0,
+    **kwargs,
+):
+    log = logging.getLogger("waretomo")
+    jobs = aretomo_jobs(tilt_series, suffix=suffix, label=label, cmd=cmd, **kwargs)
+    gpus = get_gpus(gpus)
+    log.info(f"Running AreTomo in parallel on {len(gpus)} GPUs.")
 
-    run_threaded(progress, partials, label=label, max_workers=len(gpus), **kwargs)
+    run_jobs(progress, jobs, gpus=gpus, gpu_slots=gpu_slots, retries=retries, **kwargs)
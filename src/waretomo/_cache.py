@@ -0,0 +1,126 @@
+import json
+import logging
+import os
+import tempfile
+from threading import Lock
+
+CACHE_VERSION = 1
+
+
+def fingerprint(path):
+    """Cheap identity of a file's content, used to invalidate cached data."""
+    st = os.stat(path)
+    return [st.st_mtime_ns, st.st_size]
+
+
+class ParseCache:
+    """
+    Persistent on-disk index of data extracted from input files.
+
+    Entries are keyed by path and invalidated automatically when the file's
+    mtime or size change. Pass `path=None` to get a cache that never persists.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._data = {}
+        self._lock = Lock()
+        self._dirty = False
+        if path is not None and path.exists():
+            try:
+                content = json.loads(path.read_text())
+            except (OSError, ValueError):
+                logging.getLogger("waretomo").warning(
+                    f"Parse cache {path} is unreadable, ignoring it."
+                )
+            else:
+                if content.get("version") == CACHE_VERSION:
+                    self._data = content["entries"]
+
+    def get(self, path, reader):
+        """Return reader(path), from the cache if the file did not change."""
+        key = str(path)
+        fp = fingerprint(path)
+        entry = self._data.get(key)
+        if entry is not None and entry["fingerprint"] == fp:
+            return entry["data"]
+        data = reader(path)
+        with self._lock:
+            self._data[key] = {"fingerprint": fp, "data": data}
+            self._dirty = True
+        return data
+
+    def save(self):
+        if self.path is None or not self._dirty:
+            return
+        # unique, in case other workers are saving the same cache
+        fd, tmp = tempfile.mkstemp(dir=self.path.parent, prefix=f".{self.path.name}")
+        with self._lock:
+            with os.fdopen(fd, "w") as f:
+                json.dump({"version": CACHE_VERSION, "entries": self._data}, f)
+            os.replace(tmp, self.path)
+            self._dirty = False
+
+
+def partial_path(output):
+    """
+    Temporary name to write an output to, before renaming it into place.
+
+    Renaming is atomic, so an output is either complete or missing, even if
+    we are killed while writing it.
+    """
+    # hidden, so it does not get picked up by globs (e.g: topaz training inputs)
+    return output.with_name(f".{output.name}.partial")
+
+
+def _manifest_path(output):
+    # hidden, so it does not get picked up by globs (e.g: topaz training inputs)
+    return output.with_name(f".{output.name}.waretomo.json")
+
+
+def describe_job(inputs, params):
+    """Fingerprint the inputs and parameters that will produce an output."""
+    return {
+        "inputs": {
+            str(path): fingerprint(path) if os.path.exists(path) else None
+            for path in inputs
+            if path is not None
+        },
+        "params": json.loads(json.dumps(params, default=str)),
+    }
+
+
+def check_up_to_date(output, description):
+    """
+    Raise FileExistsError if output exists and was made with the same description.
+
+    Outputs from older runs without a manifest are also considered up to date.
+    """
+    if not output.exists():
+        return
+    manifest = _manifest_path(output)
+    if not manifest.exists():
+        logging.getLogger("waretomo").info(
+            f"{output} has no manifest, assuming it is up to date."
+        )
+        raise FileExistsError(output)
+    try:
+        previous = json.loads(manifest.read_text())
+    except (OSError, ValueError):
+        return
+    if previous == description:
+        raise FileExistsError(output)
+    logging.getLogger("waretomo").info(f"{output} is outdated and will be remade.")
+
+
+def invalidate(output):
+    """Mark an existing output as incomplete, so check_up_to_date does not skip it."""
+    if os.path.exists(output):
+        write_manifest(output, {"incomplete": True})
+
+
+def write_manifest(output, description):
+    manifest = _manifest_path(output)
+    tmp = partial_path(manifest)
+    tmp.write_text(json.dumps(description, indent=1))
+    os.replace(tmp, manifest)
@@ -1,16 +1,64 @@
 import logging
+import os
+import re
 
-import pandas as pd
-from mdocfile.data_models import Mdoc
+import numpy as np
 
-from ._threaded import run_threaded
+from ._cache import check_up_to_date, describe_job, partial_path, write_manifest
+from ._threaded import Job, run_jobs
 
+TILT_ANGLE = re.compile(r"^(\s*TiltAngle\s*=\s*)\S+", re.MULTILINE)
 
-def _tilt_mdoc(mdoc_file, tlt_file, skipped_tilts, dry_run=False, overwrite=False):
+
+def _read_tlt(tlt_file):
+    with open(tlt_file) as f:
+        return np.array([float(line) for line in f if line.strip()])
+
+
+def _remap_angles(tilt_angles, new_angles, skipped_tilts, tlt_file):
+    """
+    Assign the angles refined by aretomo to the tilts in the mdoc.
+
+    The mdoc is out of order, but aretomo outputs the angles sorted (and without
+    the skipped tilts), so they go to the sections in the same order.
+    """
+    tilt_angles = np.asarray(tilt_angles, dtype=float)
+    order = np.argsort(tilt_angles, kind="stable")
+    kept = order[~np.isin(order, list(skipped_tilts))]
+    if len(new_angles) < len(kept):
+        raise RuntimeError(
+            f"not enough tilts generated by aretomo in {tlt_file}, "
+            f"or Mdoc is corrupted"
+        )
+    if len(new_angles) > len(kept):
+        raise RuntimeError(f"too many tilts generated by aretomo in {tlt_file}")
+    remapped = tilt_angles.copy()
+    remapped[kept] = new_angles
+    return remapped
+
+
+def _set_tilt_angles(text, tilt_angles, mdoc_file):
+    """Replace the tilt angle of each section, leaving everything else untouched."""
+    start = max(text.find("[ZValue"), 0)
+    sections = text[start:]
+    if len(TILT_ANGLE.findall(sections)) != len(tilt_angles):
+        raise RuntimeError(f"Mdoc is corrupted: {mdoc_file}")
+    values = iter(tilt_angles)
+    return text[:start] + TILT_ANGLE.sub(
+        lambda m: f"{m.group(1)}{float(next(values))}", sections
+    )
+
+
+def _tilt_mdoc(
+    mdoc_file, tlt_file, tilt_angles, skipped_tilts, dry_run=False, overwrite=False
+):
     output = mdoc_file.parent / "mdoc_tilted" / mdoc_file.name
 
-    if not overwrite and output.exists():
-        raise FileExistsError(output)
+    description = describe_job(
+        [mdoc_file, tlt_file], {"skipped_tilts": list(skipped_tilts)}
+    )
+    if not overwrite:
+        check_up_to_date(output, description)
 
     log = logging.getLogger("waretomo")
     log.info(f"Tilting mdoc: {mdoc_file}")
@@ -18,46 +66,37 @@ def _tilt_mdoc(mdoc_file, tlt_file, skipped_tilts, dry_run=False, overwrite=Fals
     log.info(f"saving to {output}")
 
     if not dry_run:
-        mdoc = Mdoc.from_file(mdoc_file)
-        new_angles = iter(pd.read_csv(tlt_file, header=None)[0])
-        # mdoc is still out of order, but aretomo puts the new_angles in order
-        # this gives us tuples like (original_index, section), but ordered by angle
-        # like aretomo so we can compare it with the new angles
-        sorted_section_data = sorted(
-            enumerate(mdoc.section_data), key=lambda x: x[1].TiltAngle
+        # angles were already parsed with the rest of the data
+        new_angles = _remap_angles(
+            tilt_angles, _read_tlt(tlt_file), skipped_tilts, tlt_file
         )
-        for idx, section in sorted_section_data:
-            if idx in skipped_tilts:
-                continue
-            try:
-                section.TiltAngle = next(new_angles)
-            except StopIteration as e:
-                raise RuntimeError(
-                    f"not enough tilts generated by aretomo in {tlt_file}, "
-                    f"or Mdoc is corrupted"
-                ) from e
-
-        try:
-            next(new_angles)
-        except StopIteration:
-            pass
-        else:
-            raise RuntimeError(f"too many tilts generated by aretomo in {tlt_file}")
-
-        with open(output, "w+" if overwrite else "w") as f:
-            f.write(mdoc.to_string())
+        text = _set_tilt_angles(mdoc_file.read_text(), new_angles, mdoc_file)
+        tmp = partial_path(output)
+        tmp.write_text(text)
+        os.replace(tmp, output)
+        write_manifest(output, description)
 
 
-def tilt_mdocs_batch(progress, tilt_series, **kwargs):
-    partials = []
-    for ts in tilt_series:
-        partials.append(
+def tilt_mdoc_jobs(tilt_series, dry_run=False, overwrite=False):
+    return [
+        Job(
             lambda ts=ts: _tilt_mdoc(
                 mdoc_file=ts["mdoc"],
                 tlt_file=ts["tlt"],
+                tilt_angles=ts["tilt_angles"],
                 skipped_tilts=ts["skipped_tilts"],
-                **kwargs,
-            )
+                dry_run=dry_run,
+                overwrite=overwrite,
+            ),
+            label="Creating tilted mdocs",
+            name=ts["name"],
+            inputs=[ts["mdoc"], ts["tlt"]],
+            outputs=[ts["mdoc"].parent / "mdoc_tilted" / ts["mdoc"].name],
         )
+        for ts in tilt_series
+    ]
+
 
-    run_threaded(progress, partials, label="Creating tilted mdocs...", **kwargs)
+def tilt_mdocs_batch(progress, tilt_series, **kwargs):
+    jobs = tilt_mdoc_jobs(tilt_series, **kwargs)
+    run_jobs(progress, jobs, **kwargs)
@@ -0,0 +1,150 @@
+import logging
+
+# leave some headroom for the cuda context and memory fragmentation
+MEMORY_SAFETY_FACTOR = 0.9
+# hard limit when packing by memory, to avoid thrashing the gpu scheduler
+MAX_JOBS_PER_GPU = 16
+# consecutive failures after which a gpu is considered broken
+QUARANTINE_AFTER = 3
+
+
+def get_gpus(gpus=None):
+    if gpus is None:
+        import GPUtil
+
+        gpus = [gpu.id for gpu in GPUtil.getGPUs()]
+    if not gpus:
+        raise RuntimeError("you need at least one GPU to run AreTomo")
+    return gpus
+
+
+def get_free_memory(gpus):
+    """Free memory in MB for each of the given gpu ids, if GPUtil can see them."""
+    try:
+        import GPUtil
+
+        available = {gpu.id: gpu.memoryFree for gpu in GPUtil.getGPUs()}
+    except Exception:  # GPUtil fails in many creative ways without nvidia-smi
+        available = {}
+    return {gpu: available.get(gpu) for gpu in gpus}
+
+
+def is_out_of_memory(err):
+    output = (getattr(err, "stdout", None) or b"") + (
+        getattr(err, "stderr", None) or b""
+    )
+    return b"out of memory" in output.lower()
+
+
+class GpuPool:
+    """
+    Hand out gpu ids to jobs, packing multiple jobs per gpu if possible.
+
+    slots: maximum number of concurrent jobs per gpu. If 0, the number of jobs
+        is only limited by the free memory reported by GPUtil and by the memory
+        estimate of each job.
+    memory: free memory (MB) per gpu id; queried with GPUtil if not given.
+    """
+
+    def __init__(self, gpus, slots=1, memory=None):
+        self.gpus = list(gpus)
+        if memory is None:
+            memory = get_free_memory(self.gpus) if slots != 1 else {}
+        self.memory = {
+            gpu: (mem * MEMORY_SAFETY_FACTOR if mem is not None else None)
+            for gpu, mem in memory.items()
+        }
+        self.max_slots = {}
+        for gpu in self.gpus:
+            if slots:
+                self.max_slots[gpu] = slots
+            elif self.memory.get(gpu) is None:
+                # no way to know how much we can pack, be conservative
+                self.max_slots[gpu] = 1
+            else:
+                self.max_slots[gpu] = MAX_JOBS_PER_GPU
+        self.running = dict.fromkeys(self.gpus, 0)
+        self.used_memory = dict.fromkeys(self.gpus, 0)
+        self.failures = dict.fromkeys(self.gpus, 0)
+        self.quarantined = set()
+
+    def __len__(self):
+        return len(self.gpus)
+
+    @property
+    def total_slots(self):
+        return sum(self.max_slots.values())
+
+    def _fits(self, gpu, mem):
+        if self.running[gpu] == 0:
+            # a single job always gets a chance, even if the estimate is too high
+            return True
+        if self.running[gpu] >= self.max_slots[gpu]:
+            return False
+        total = self.memory.get(gpu)
+        return total is None or self.used_memory[gpu] + mem <= total
+
+    @property
+    def healthy(self):
+        return [gpu for gpu in self.gpus if gpu not in self.quarantined]
+
+    def acquire(self, mem=0, avoid=()):
+        """
+        Return the least busy gpu that can fit a job, or None if none can.
+
+        avoid: gpus on which this job failed before; they are only used if no
+            other healthy gpu is left.
+        """
+        healthy = self.healthy
+        if any(gpu not in avoid for gpu in healthy):
+            healthy = [gpu for gpu in healthy if gpu not in avoid]
+        candidates = [gpu for gpu in healthy if self._fits(gpu, mem)]
+        if not candidates:
+            return None
+        gpu = min(candidates, key=lambda gpu: self.running[gpu])
+        self.running[gpu] += 1
+        self.used_memory[gpu] += mem
+        return gpu
+
+    def release(self, gpu, mem=0):
+        self.running[gpu] -= 1
+        self.used_memory[gpu] -= mem
+
+    def report(self, gpu, success):
+        """
+        Keep track of failures, and quarantine gpus that keep failing.
+
+        Only failures which are the gpu's fault should be reported, not those
+        caused by bad inputs, or a healthy gpu ends up quarantined.
+        """
+        if success:
+            self.failures[gpu] = 0
+            return
+        self.failures[gpu] += 1
+        if self.failures[gpu] >= QUARANTINE_AFTER and len(self.healthy) > 1:
+            self.quarantined.add(gpu)
+            logging.getLogger("waretomo").warning(
+                f"GPU {gpu} failed {self.failures[gpu]} jobs in a row; "
+                "it will not be used for the rest of the run."
+            )
+
+    def back_off(self, gpu, started_with=None):
+        """
+        Reduce the number of concurrent jobs on a gpu after running out of memory.
+
+        started_with: the maximum number of jobs on this gpu when the failed job
+            was started; if we already backed off since then, do nothing more.
+
+        Returns False if the gpu was already limited to a single job at a time.
+        """
+        if started_with is not None and self.max_slots[gpu] < started_with:
+            return True
+        if self.max_slots[gpu] <= 1:
+            return False
+        # running still includes the failed job at this point
+        self.max_slots[gpu] = max(1, min(self.running[gpu], self.max_slots[gpu]) - 1)
+        logging.getLogger("waretomo").warning(
+            f"GPU {gpu} ran out of memory; "
+            f"limiting it to {self.max_slots[gpu]} concurrent jobs."
+        )
+        return True
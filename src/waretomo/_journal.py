@@ -0,0 +1,83 @@
+import json
+import logging
+import threading
+import time
+from pathlib import Path
+
+from ._cache import invalidate, partial_path
+
+
+class Journal:
+    """
+    Append-only record of the jobs started and finished in an output directory.
+
+    A job whose last event is "started" was interrupted (e.g. the node died), so
+    its outputs may be incomplete; `resume` removes them, and `invalidate` marks
+    them as incomplete, so the job runs again either way. This matters for
+    outputs written in place (e.g. aligned stacks, which aretomo names other
+    outputs after), which would otherwise look like complete outputs from before
+    manifests existed. Other outputs are renamed into place once complete.
+
+    With a WorkQueue, jobs still claimed by a live worker are only running
+    elsewhere, and are not considered interrupted.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+
+    def record(self, event, key, outputs=()):
+        line = json.dumps(
+            {
+                "time": time.time(),
+                "event": event,
+                "job": key,
+                "outputs": [str(output) for output in outputs],
+            }
+        )
+        with self._lock:
+            # single small appends, so concurrent workers don't mix lines
+            with open(self.path, "a") as f:
+                f.write(line + "\n")
+
+    def interrupted(self, queue=None):
+        """Return the outputs of each job which started but never finished."""
+        last = {}
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # the last line may be truncated by a crash
+                        continue
+                    last[entry["job"]] = entry
+        except FileNotFoundError:
+            pass
+        return {
+            key: [Path(output) for output in entry["outputs"]]
+            for key, entry in last.items()
+            if entry["event"] == "started"
+            and (queue is None or queue.status(key) != "claimed")
+        }
+
+    def resume(self, queue=None):
+        """Remove whatever interrupted jobs left behind; return their names."""
+        log = logging.getLogger("waretomo")
+        interrupted = self.interrupted(queue)
+        for key, outputs in interrupted.items():
+            log.info(f"Redoing {key}, which was interrupted.")
+            for output in outputs:
+                output.unlink(missing_ok=True)
+                partial_path(output).unlink(missing_ok=True)
+            self.record("reset", key)
+        return list(interrupted)
+
+    def invalidate(self, queue=None):
+        """Mark what interrupted jobs left behind as incomplete; return their names."""
+        interrupted = self.interrupted(queue)
+        for key, outputs in interrupted.items():
+            for output in outputs:
+                invalidate(output)
+            self.record("reset", key)
+        return list(interrupted)
@@ -1,8 +1,173 @@
 import logging
+from concurrent import futures
+from functools import partial
 from pathlib import Path, PureWindowsPath
 from xml.etree import ElementTree
 
-from mdocfile.data_models import Mdoc
+from ._cache import ParseCache
+
+
+def _read_mdoc(mdoc_file):
+    # slow to import (pandas, pydantic), and not needed if the cache is warm
+    from mdocfile.data_models import Mdoc
+
+    mdoc = Mdoc.from_file(mdoc_file)
+    return {
+        "image_file": str(mdoc.global_data.ImageFile),
+        "sub_frame_paths": [str(tilt.SubFramePath) for tilt in mdoc.section_data],
+        "tilt_angles": [tilt.TiltAngle for tilt in mdoc.section_data],
+        "dose": mdoc.section_data[0].ExposureDose,
+        "px_size": mdoc.section_data[0].PixelSpacing,
+    }
+
+
+def _read_xml(xml_file):
+    xml = ElementTree.parse(xml_file).getroot()
+    data = {"unselect_manual": xml.attrib["UnselectManual"] == "True"}
+    for param in xml.findall("OptionsCTF/Param"):
+        if param.get("Name") == "BinTimes":
+            data["bin_times"] = float(param.get("Value"))
+        elif param.get("Name") == "Voltage":
+            data["voltage"] = int(param.get("Value"))
+        elif param.get("Name") == "Cs":
+            data["cs"] = float(param.get("Value"))
+    for param in xml.findall("CTF/Param"):
+        if param.get("Name") == "Defocus":
+            data["defocus"] = float(param.get("Value"))
+    return data
+
+
+def _parse_tilt_series(
+    mdoc_file,
+    warp_dir,
+    output_dir,
+    roi_dir,
+    exclude=(),
+    train=False,
+    dose=None,
+    cache=None,
+):
+    log = logging.getLogger("waretomo")
+    cache = ParseCache() if cache is None else cache
+
+    imod_dir = warp_dir / "imod"
+    odd_dir = warp_dir / "average" / "odd"
+    even_dir = warp_dir / "average" / "even"
+
+    log.info(f"Parsing {mdoc_file}.")
+    mdoc = cache.get(mdoc_file, _read_mdoc)
+
+    # warp uses mdoc name in many places, but some times the ts_name is important
+    mdoc_name = mdoc_file.stem
+    ts_name = Path(mdoc["image_file"]).stem
+    stack = imod_dir / mdoc_name / (mdoc_name + ".st")
+
+    if ts_name in exclude or mdoc_name in exclude:
+        return "excluded", ts_name
+    # skip if not preprocessed in warp
+    if not stack.exists():
+        return "unprocessed", ts_name
+
+    # extract even/odd paths
+    tilts = [warp_dir / PureWindowsPath(tilt).name for tilt in mdoc["sub_frame_paths"]]
+    skipped_tilts = []
+    odd = []
+    even = []
+    valid_xml = None
+    for i, tilt in enumerate(tilts):
+        if not tilt.exists():
+            log.warning(
+                f"{tilt.name} is listed in an mdoc file, "
+                "but the file does not exists. "
+                "The tilt will be skipped, "
+                "but you may want to check your data."
+            )
+            skipped_tilts.append(i)
+            continue
+
+        xml = cache.get(tilt.with_suffix(".xml"), _read_xml)
+        if xml["unselect_manual"]:
+            skipped_tilts.append(i)
+        else:
+            valid_xml = xml
+            odd.append(odd_dir / (tilt.stem + ".mrc"))
+            even.append(even_dir / (tilt.stem + ".mrc"))
+
+    if valid_xml is None:
+        return "unprocessed", ts_name
+
+    if train:
+        for img in odd + even:
+            if not img.exists():
+                raise FileNotFoundError(img)
+
+    # extract metadata from warp xmls
+    # (we assume the last xml has the same data as the others)
+    binning = valid_xml["bin_times"]
+    kv = valid_xml["voltage"]
+    cs = valid_xml["cs"]
+    defocus = xml["defocus"] * 1e4  # defocus for aretomo is in Angstrom
+
+    if roi_dir is not None:
+        roi_files = list(roi_dir.glob(f"{ts_name}*"))
+        if len(roi_files) == 1:
+            roi_file = roi_files[0]
+        else:
+            roi_file = None
+    else:
+        roi_file = None
+
+    dose = mdoc["dose"] if dose is None else dose
+    if not dose:
+        log.error("Exposure dose not present in mdoc! Setting to 0.")
+    px_size_raw = mdoc["px_size"]
+    if not px_size_raw:
+        log.error("Pixel spacing not present in mdoc! Setting to 1.")
+
+    # aretomo being weird about paths and names splitting needs extra care...
+    ts_aligned = ts_name.split(".")[0] + "_aligned"
+    alignment_result_dir = output_dir / (ts_aligned + ".st_Imod")
+
+    return (
+        "ready",
+        {
+            "name": ts_name,
+            "mdoc": mdoc_file,
+            "stack": stack,
+            "rawtlt": stack.with_suffix(".rawtlt"),
+            "xf": alignment_result_dir / (ts_aligned + ".xf"),
+            "tlt": alignment_result_dir / (ts_aligned + ".tlt"),
+            "aln": output_dir / (mdoc_name + ".st.aln"),
+            "tilt_angles": mdoc["tilt_angles"],
+            "skipped_tilts": skipped_tilts,
+            "roi": roi_file,
+            "odd": odd,
+            "even": even,
+            "stack_odd": output_dir / (ts_name + "_odd.st"),
+            "stack_even": output_dir / (ts_name + "_even.st"),
+            "recon_odd": output_dir / "odd" / (ts_name + ".mrc"),
+            "recon_even": output_dir / "even" / (ts_name + ".mrc"),
+            "recon": output_dir / (ts_name + ".mrc"),
+            "recon_preview": output_dir / "preview" / (ts_name + ".mrc"),
+            "aretomo_kwargs": {
+                "dose": dose,
+                "px_size": px_size_raw * 2**binning,
+                "cs": cs,
+                "kv": kv,
+                "defocus": defocus,
+            },
+        },
+    )
+
+
+def _parse_or_skip(parse, mdoc_file):
+    try:
+        return parse(mdoc_file)
+    except Exception as e:
+        logging.getLogger("waretomo").warning(
+            f"Could not parse {mdoc_file.name} ({e!r}), skipping it for now."
+        )
+        return "unprocessed", mdoc_file.stem
 
 
 def parse_data(
@@ -15,14 +180,30 @@ def parse_data(
     exclude=(),
     train=False,
     dose=None,
+    max_workers=None,
+    cache_file=None,
+    cache=None,
+    mdocs=None,
+    skip_errors=False,
 ):
-    log = logging.getLogger("waretomo")
+    """
+    Find the tilt series ready to be processed, and gather their metadata.
+
+    Returns the tilt series which are ready, and the names of those which are
+    excluded or not ready yet (e.g. not preprocessed in warp).
 
+    cache: ParseCache to use, instead of loading one from cache_file
+    mdocs: only parse these mdoc files, instead of those in mdoc_dir (or `just`)
+    skip_errors: if True, tilt series which cannot be parsed (e.g. mdocs still
+        being written) are logged and counted as not ready, instead of raising
+    """
     imod_dir = warp_dir / "imod"
     if not imod_dir.exists():
         raise FileNotFoundError("warp directory does not have an `imod` subdirectory")
 
-    if just:
+    if mdocs is not None:
+        mdocs = list(mdocs)
+    elif just:
         mdocs = [
             p
             for ts_name in just
@@ -34,128 +215,41 @@ def parse_data(
     if not mdocs:
         raise FileNotFoundError("could not find any mdoc files")
 
-    odd_dir = warp_dir / "average" / "odd"
-    even_dir = warp_dir / "average" / "even"
-
     tilt_series = []
     tilt_series_excluded = []
     tilt_series_unprocessed = []
 
-    for mdoc_file in progress.track(mdocs, description="Reading mdocs..."):
-        log.info(f"Parsing {mdoc_file}.")
-        mdoc = Mdoc.from_file(mdoc_file)
-
-        # warp uses mdoc name in many places, but some times the ts_name is important
-        mdoc_name = mdoc_file.stem
-        ts_name = mdoc.global_data.ImageFile.stem
-        stack = imod_dir / mdoc_name / (mdoc_name + ".st")
-
-        if ts_name in exclude or mdoc_name in exclude:
-            tilt_series_excluded.append(ts_name)
-            continue
-        # skip if not preprocessed in warp
-        if not stack.exists():
-            tilt_series_unprocessed.append(ts_name)
-            continue
-
-        # extract even/odd paths
-        tilts = [
-            warp_dir / PureWindowsPath(tilt.SubFramePath).name
-            for tilt in mdoc.section_data
-        ]
-        skipped_tilts = []
-        odd = []
-        even = []
-        valid_xml = None
-        for i, tilt in enumerate(tilts):
-            if not tilt.exists():
-                log.warning(
-                    f"{tilt.name} is listed in an mdoc file, "
-                    "but the file does not exists. "
-                    "The tilt will be skipped, "
-                    "but you may want to check your data."
-                )
-                skipped_tilts.append(i)
-                continue
-
-            xml = ElementTree.parse(tilt.with_suffix(".xml")).getroot()
-            if xml.attrib["UnselectManual"] == "True":
-                skipped_tilts.append(i)
+    # extracted mdoc/xml data is cached across runs, keyed by path, mtime and size
+    if cache is None:
+        cache = ParseCache(cache_file)
+    parse = partial(
+        _parse_tilt_series,
+        cache=cache,
+        warp_dir=warp_dir,
+        output_dir=output_dir,
+        roi_dir=roi_dir,
+        exclude=exclude,
+        train=train,
+        dose=dose,
+    )
+
+    if skip_errors:
+        parse = partial(_parse_or_skip, parse)
+
+    # mostly io-bound (especially on network filesystems), so threads are enough;
+    # map preserves the order of the mdocs, so the output is deterministic
+    with futures.ThreadPoolExecutor(max_workers) as executor:
+        results = executor.map(parse, mdocs)
+        for status, result in progress.track(
+            results, total=len(mdocs), description="Reading mdocs..."
+        ):
+            if status == "excluded":
+                tilt_series_excluded.append(result)
+            elif status == "unprocessed":
+                tilt_series_unprocessed.append(result)
             else:
-                valid_xml = xml
-                odd.append(odd_dir / (tilt.stem + ".mrc"))
-                even.append(even_dir / (tilt.stem + ".mrc"))
+                tilt_series.append(result)
 
-        if valid_xml is None:
-            tilt_series_unprocessed.append(ts_name)
-            continue
-
-        if train:
-            for img in odd + even:
-                if not img.exists():
-                    raise FileNotFoundError(img)
-
-        # extract metadata from warp xmls
-        # (we assume the last xml has the same data as the others)
-        for param in valid_xml.find("OptionsCTF"):
-            if param.get("Name") == "BinTimes":
-                binning = float(param.get("Value"))
-            elif param.get("Name") == "Voltage":
-                kv = int(param.get("Value"))
-            elif param.get("Name") == "Cs":
-                cs = float(param.get("Value"))
-        for param in xml.find("CTF"):
-            if param.get("Name") == "Defocus":
-                defocus = (
-                    float(param.get("Value")) * 1e4
-                )  # defocus for aretomo is in Angstrom
-
-        if roi_dir is not None:
-            roi_files = list(roi_dir.glob(f"{ts_name}*"))
-            if len(roi_files) == 1:
-                roi_file = roi_files[0]
-            else:
-                roi_file = None
-        else:
-            roi_file = None
-
-        dose = mdoc.section_data[0].ExposureDose if dose is None else dose
-        if not dose:
-            log.error("Exposure dose not present in mdoc! Setting to 0.")
-        px_size_raw = mdoc.section_data[0].PixelSpacing
-        if not px_size_raw:
-            log.error("Pixel spacing not present in mdoc! Setting to 1.")
-
-        # aretomo being weird about paths and names splitting needs extra care...
-        ts_aligned = ts_name.split(".")[0] + "_aligned"
-        alignment_result_dir = output_dir / (ts_aligned + ".st_Imod")
-
-        tilt_series.append(
-            {
-                "name": ts_name,
-                "mdoc": mdoc_file,
-                "stack": stack,
-                "rawtlt": stack.with_suffix(".rawtlt"),
-                "xf": alignment_result_dir / (ts_aligned + ".xf"),
-                "tlt": alignment_result_dir / (ts_aligned + ".tlt"),
-                "aln": output_dir / (mdoc_name + ".st.aln"),
-                "skipped_tilts": skipped_tilts,
-                "roi": roi_file,
-                "odd": odd,
-                "even": even,
-                "stack_odd": output_dir / (ts_name + "_odd.st"),
-                "stack_even": output_dir / (ts_name + "_even.st"),
-                "recon_odd": output_dir / "odd" / (ts_name + ".mrc"),
-                "recon_even": output_dir / "even" / (ts_name + ".mrc"),
-                "recon": output_dir / (ts_name + ".mrc"),
-                "aretomo_kwargs": {
-                    "dose": dose,
-                    "px_size": px_size_raw * 2**binning,
-                    "cs": cs,
-                    "kv": kv,
-                    "defocus": defocus,
-                },
-            }
-        )
+    cache.save()
 
     return tilt_series, tilt_series_excluded, tilt_series_unprocessed
@@ -0,0 +1,248 @@
+from datetime import timedelta
+
+
+def print_prediction(
+    progress,
+    tilt_series,
+    passes,
+    output_dir,
+    gpus=None,
+    gpu_slots=1,
+    history=None,
+    **kwargs,
+):
+    """
+    Print how long each gpu step, and the whole pipeline, should take.
+
+    passes: the steps of each pass over the tilt series (e.g. previews, then the
+        rest), each of which starts once the previous one is done.
+    Other kwargs are passed to build_pipeline.
+    """
+    from ._gpu import GpuPool, get_gpus
+    from ._runtime import predict_makespan
+
+    graphs = [
+        build_pipeline(tilt_series, steps, output_dir, history=history, **kwargs)
+        for steps in passes
+    ]
+    if not any(job.gpu for jobs in graphs for job in jobs):
+        return
+    gpus = get_gpus(gpus)
+    pool = GpuPool(gpus, slots=gpu_slots)
+    on = f"on {len(gpus)} GPUs"
+    if gpu_slots == 0:
+        on += " (packed by memory)"
+    elif gpu_slots > 1:
+        on += f" ({gpu_slots} jobs each)"
+    lines = ["[bold]Predicted runtime[/bold]:"]
+    total = 0
+    for jobs in graphs:
+        for label in dict.fromkeys(job.label for job in jobs if job.gpu):
+            step = [job for job in jobs if job.label == label]
+            makespan = timedelta(seconds=round(predict_makespan(step, pool=pool)))
+            lines.append(f"- {label}: {len(step)} jobs, ~{makespan} {on}")
+        total += predict_makespan(jobs, pool=pool)
+    lines.append(f"- all steps: ~{timedelta(seconds=round(total))} {on}")
+    if history is None or not history.records:
+        lines.append("(no runtime history yet: this is a rough guess)")
+    progress.console.print("\n".join(lines))
+
+
+def build_pipeline(
+    tilt_series,
+    steps,
+    output_dir,
+    aretomo_kwargs,
+    tilt_corr=True,
+    newstack=None,
+    preview_binning=16,
+    preview_thickness=None,
+    scratch=None,
+    history=None,
+    dry_run=False,
+    overwrite=False,
+):
+    """
+    Generate the graph of jobs needed to process each tilt series.
+
+    Each tilt series goes through its own steps as soon as its inputs exist,
+    independently from the others. Steps which are not selected are simply not
+    added to the graph, and their outputs are assumed to exist already.
+
+    Previews are quick reconstructions from the same alignment, at
+    `preview_binning` and `preview_thickness` (default: the alignment thickness),
+    each with a png of its central slab.
+
+    If scratch is given, aretomo jobs run on local copies of their inputs.
+    If history is given, it is used to predict the runtime of aretomo jobs.
+    """
+    meta_kwargs = {"dry_run": dry_run, "overwrite": overwrite}
+    aretomo_kwargs = {
+        k: v
+        for k, v in aretomo_kwargs.items()
+        if k not in ("gpus", "gpu_slots", "retries")
+    }
+
+    jobs = []
+
+    align = {}
+    if steps["align"]:
+        from ._aretomo import aretomo_jobs
+
+        align_jobs = aretomo_jobs(
+            tilt_series,
+            label="Aligning",
+            scratch=scratch,
+            history=history,
+            **aretomo_kwargs,
+            **meta_kwargs,
+        )
+        align = {job.name: job for job in align_jobs}
+        jobs += align_jobs
+
+    if steps["tilt_mdocs"] and tilt_corr:
+        from ._fix_mdoc import tilt_mdoc_jobs
+
+        for ts in tilt_series:
+            (ts["mdoc"].parent / "mdoc_tilted").mkdir(parents=True, exist_ok=True)
+        for job in tilt_mdoc_jobs(tilt_series, **meta_kwargs):
+            job.deps.extend(filter(None, [align.get(job.name)]))
+            jobs.append(job)
+
+    if steps["preview"]:
+        from ._aretomo import aretomo_jobs
+        from ._preview import preview_image_jobs
+
+        (output_dir / "preview").mkdir(parents=True, exist_ok=True)
+        preview_jobs = aretomo_jobs(
+            tilt_series,
+            reconstruct=True,
+            output="recon_preview",
+            label="Previewing",
+            scratch=scratch,
+            history=history,
+            **{
+                **aretomo_kwargs,
+                "binning": preview_binning,
+                "thickness_recon": preview_thickness
+                or aretomo_kwargs.get("thickness_align", 1200),
+            },
+            **meta_kwargs,
+        )
+        for job in preview_jobs:
+            job.deps.extend(filter(None, [align.get(job.name)]))
+        preview = {job.name: job for job in preview_jobs}
+        jobs += preview_jobs
+        for job in preview_image_jobs(tilt_series, **meta_kwargs):
+            job.deps.append(preview[job.name])
+            jobs.append(job)
+
+    if steps["reconstruct"]:
+        from ._aretomo import aretomo_jobs
+
+        for job in aretomo_jobs(
+            tilt_series,
+            reconstruct=True,
+            label="Reconstructing",
+            scratch=scratch,
+            history=history,
+            **aretomo_kwargs,
+            **meta_kwargs,
+        ):
+            job.deps.extend(filter(None, [align.get(job.name)]))
+            jobs.append(job)
+
+    for half in ("even", "odd"):
+        stack = {}
+        if steps["stack_halves"]:
+            from ._stack import half_stack_jobs
+
+            stack_jobs = half_stack_jobs(
+                tilt_series, half=half, cmd=newstack, **meta_kwargs
+            )
+            stack = {job.name: job for job in stack_jobs}
+            jobs += stack_jobs
+
+        if steps["reconstruct_halves"]:
+            from ._aretomo import aretomo_jobs
+
+            (output_dir / half).mkdir(parents=True, exist_ok=True)
+            for job in aretomo_jobs(
+                tilt_series,
+                suffix=f"_{half}",
+                reconstruct=True,
+                label=f"Reconstructing {half} halves",
+                scratch=scratch,
+                history=history,
+                **aretomo_kwargs,
+                **meta_kwargs,
+            ):
+                job.deps.extend(
+                    filter(None, [align.get(job.name), stack.get(job.name)])
+                )
+                jobs.append(job)
+
+    return jobs
+
+
+def run_pipeline(
+    progress,
+    tilt_series,
+    steps,
+    output_dir,
+    gpus=None,
+    gpu_slots=1,
+    retries=0,
+    scratch=None,
+    scratch_size=None,
+    tracer=None,
+    queue=None,
+    history=None,
+    journal=None,
+    **kwargs,
+):
+    from ._gpu import get_gpus
+    from ._threaded import run_jobs
+
+    if scratch is not None and not kwargs.get("dry_run"):
+        from ._scratch import Scratch
+
+        scratch = Scratch(scratch, capacity=scratch_size)
+    else:
+        scratch = None
+
+    try:
+        jobs = build_pipeline(
+            tilt_series, steps, output_dir, scratch=scratch, history=history, **kwargs
+        )
+        if any(job.gpu for job in jobs):
+            gpus = get_gpus(gpus)
+        else:
+            gpus = ()
+
+        state = run_jobs(
+            progress,
+            jobs,
+            gpus=gpus,
+            gpu_slots=gpu_slots,
+            retries=retries,
+            tracer=tracer,
+            queue=queue,
+            history=history,
+            journal=journal,
+            dry_run=kwargs.get("dry_run"),
+        )
+    finally:
+        if scratch is not None:
+            scratch.close()
+
+    if steps["reconstruct_halves"]:
+        # remove leftovers from aretomo otherwise topaz dies later
+        for half in ("even", "odd"):
+            half_dir = output_dir / half
+            for f in half_dir.glob("*_projX?.mrc"):
+                f.unlink(missing_ok=True)
+            for f in half_dir.glob("*.aretomolog"):
+                f.unlink(missing_ok=True)
+
+    return state
@@ -0,0 +1,91 @@
+import logging
+import os
+import struct
+import zlib
+
+from ._cache import check_up_to_date, describe_job, partial_path, write_manifest
+from ._threaded import Job
+
+# tilt series listed here (one name per line) are left out of full processing
+REJECTED_FILE = "rejected.txt"
+# fraction of the thickness averaged around the center of the preview volume
+SLAB_FRACTION = 0.25
+# contrast limits (percentiles) of the preview images
+CONTRAST_LIMITS = (1, 99)
+
+
+def read_rejected(preview_dir):
+    """Names of the tilt series rejected after looking at their preview."""
+    try:
+        lines = (preview_dir / REJECTED_FILE).read_text().splitlines()
+    except FileNotFoundError:
+        return []
+    return [line.strip() for line in lines if line.strip()]
+
+
+def _write_png(path, image):
+    """Write a 2D uint8 array as a grayscale png (no need for an imaging library)."""
+
+    def chunk(kind, data):
+        crc = zlib.crc32(kind + data)
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", crc)
+
+    height, width = image.shape
+    # each row starts with its filter type (0: none)
+    rows = b"".join(b"\x00" + row.tobytes() for row in image)
+    with open(path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0)))
+        f.write(chunk(b"IDAT", zlib.compress(rows)))
+        f.write(chunk(b"IEND", b""))
+
+
+def central_slab(volume):
+    """Average of the slices around the center of a (z, y, x) volume."""
+    import numpy as np
+
+    depth = volume.shape[0]
+    n = max(1, round(depth * SLAB_FRACTION))
+    start = (depth - n) // 2
+    return np.asarray(volume[start : start + n], dtype=np.float32).mean(axis=0)
+
+
+def _write_preview(volume_file, output, dry_run=False, overwrite=False):
+    description = describe_job([volume_file], {"slab_fraction": SLAB_FRACTION})
+    if not overwrite:
+        check_up_to_date(output, description)
+
+    logging.getLogger("waretomo").info(f"Writing preview of {volume_file} to {output}")
+
+    if not dry_run:
+        import mrcfile
+        import numpy as np
+
+        with mrcfile.mmap(volume_file, permissive=True) as mrc:
+            slab = central_slab(mrc.data)
+        low, high = np.percentile(slab, CONTRAST_LIMITS)
+        image = np.clip((slab - low) / ((high - low) or 1), 0, 1)
+        # mrc images start from the bottom left, pngs from the top left
+        image = (image[::-1] * 255).astype(np.uint8)
+        tmp = partial_path(output)
+        _write_png(tmp, image)
+        os.replace(tmp, output)
+        write_manifest(output, description)
+
+
+def preview_image_jobs(tilt_series, dry_run=False, overwrite=False):
+    return [
+        Job(
+            lambda ts=ts: _write_preview(
+                ts["recon_preview"],
+                ts["recon_preview"].with_suffix(".png"),
+                dry_run=dry_run,
+                overwrite=overwrite,
+            ),
+            label="Writing previews",
+            name=ts["name"],
+            inputs=[ts["recon_preview"]],
+            outputs=[ts["recon_preview"].with_suffix(".png")],
+        )
+        for ts in tilt_series
+    ]
@@ -0,0 +1,162 @@
+import logging
+import os
+import re
+import socket
+import threading
+import time
+from pathlib import Path
+
+# how often claims on running jobs are refreshed
+HEARTBEAT_INTERVAL = 30
+# claims not refreshed for this long belong to a dead worker
+STALE_AFTER = 300
+
+
+def job_key(job):
+    """File-system friendly unique name of a job."""
+    return re.sub(r"[^\w.-]+", "_", f"{job.label}-{job.name}")
+
+
+class WorkQueue:
+    """
+    Lock-based work queue on a shared file system, for several waretomo workers.
+
+    Workers (processes, possibly on different nodes) running on the same
+    queue directory claim each job before running it, by atomically creating a
+    claim file; claims are kept alive by a heartbeat thread. Results are
+    recorded with `finish`, so a job is processed only once per queue. Claims
+    whose heartbeat stopped for longer than `stale_after` seconds (because their
+    worker died) can be taken over by other workers.
+
+    Requires a file system with atomic exclusive file creation (e.g. NFSv3+).
+    """
+
+    def __init__(self, root, heartbeat=HEARTBEAT_INTERVAL, stale_after=STALE_AFTER):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.heartbeat = heartbeat
+        self.stale_after = stale_after
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.held = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _claim_path(self, key):
+        return self.root / f"{key}.claim"
+
+    def _result_path(self, key):
+        return self.root / f"{key}.result"
+
+    def _is_stale(self, path):
+        try:
+            return time.time() - path.stat().st_mtime > self.stale_after
+        except FileNotFoundError:
+            return False
+
+    def status(self, key):
+        """
+        Return the state of a job in the queue.
+
+        "done"/"failed": finished (by any worker)
+        "mine": claimed by this worker
+        "claimed": claimed by a live worker
+        "abandoned": claimed by a worker which died
+        None: free to claim
+        """
+        try:
+            return self._result_path(key).read_text().strip()
+        except FileNotFoundError:
+            pass
+        if key in self.held:
+            return "mine"
+        claim = self._claim_path(key)
+        if not claim.exists():
+            return None
+        return "abandoned" if self._is_stale(claim) else "claimed"
+
+    def _break_stale(self, key):
+        # only one worker at a time can break claims, so two workers cannot both
+        # remove a stale claim and each create a new one; the lock itself is only
+        # held for an instant, so it's safe to break it if it gets stale too
+        lock = self.root / ".break.lock"
+        if self._is_stale(lock):
+            lock.unlink(missing_ok=True)
+        try:
+            os.close(os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            return False
+        try:
+            claim = self._claim_path(key)
+            if not self._is_stale(claim):
+                return False
+            logging.getLogger("waretomo").warning(
+                f"Recovering {key}, abandoned by {claim.read_text().strip()}"
+            )
+            claim.unlink(missing_ok=True)
+            return True
+        finally:
+            lock.unlink(missing_ok=True)
+
+    def claim(self, key):
+        """
+        Try to claim a job for this worker.
+
+        Returns None if the job is taken or finished, "new" if it was claimed,
+        or "recovered" if it was claimed after its previous worker died (its
+        outputs may be incomplete).
+        """
+        status = self.status(key)
+        if status == "mine":
+            return "new"
+        if status in ("done", "failed", "claimed"):
+            return None
+        recovered = status == "abandoned"
+        if recovered and not self._break_stale(key):
+            return None
+        try:
+            fd = os.open(self._claim_path(key), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return None
+        with os.fdopen(fd, "w") as f:
+            f.write(self.owner)
+        with self._lock:
+            self.held.add(key)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._keep_alive, daemon=True)
+                self._thread.start()
+        # someone may have finished it between our status check and the claim
+        if self._result_path(key).exists():
+            self.release(key)
+            return None
+        return "recovered" if recovered else "new"
+
+    def _keep_alive(self):
+        while not self._stop.wait(self.heartbeat):
+            with self._lock:
+                held = list(self.held)
+            for key in held:
+                try:
+                    os.utime(self._claim_path(key))
+                except FileNotFoundError:
+                    pass
+
+    def finish(self, key, status="done"):
+        """Record the result of a claimed job, and release it."""
+        result = self._result_path(key)
+        tmp = result.with_name(f".{result.name}.{self.owner.replace(':', '_')}")
+        tmp.write_text(status)
+        os.replace(tmp, result)
+        self.release(key)
+
+    def release(self, key):
+        """Give up a claimed job, so other workers can take it."""
+        with self._lock:
+            self.held.discard(key)
+        self._claim_path(key).unlink(missing_ok=True)
+
+    def close(self):
+        """Stop the heartbeat and release unfinished jobs."""
+        self._stop.set()
+        for key in list(self.held):
+            self.release(key)
@@ -0,0 +1,120 @@
+import heapq
+import json
+import logging
+import os
+import statistics
+import threading
+from pathlib import Path
+
+
+def default_history_file():
+    """Runtimes depend on the machine more than on the data, so keep them per user."""
+    cache = Path(os.environ.get("XDG_CACHE_HOME", "~/.cache")).expanduser()
+    return cache / "waretomo" / "runtimes.jsonl"
+
+
+class RuntimeHistory:
+    """
+    Runtimes of past jobs and their features, to predict how long new jobs take.
+
+    Each record has the features of a job (e.g. number of tilts, binning), a
+    size-based estimate of its amount of work in arbitrary units, and how long it
+    took. A new job is predicted to take as long as past jobs with the same
+    features, or else to run at the same speed (work per second) as past jobs of
+    the same kind, preferring those with the same patches and binning.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.records = []
+        self._lock = threading.Lock()
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        self.records.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        continue
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logging.getLogger("waretomo").warning(f"Could not read {path}: {e}")
+
+    def record(self, features, work, runtime):
+        record = {"features": features, "work": work, "runtime": runtime}
+        with self._lock:
+            self.records.append(record)
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                # single small appends, so concurrent workers don't mix lines
+                with open(self.path, "a") as f:
+                    f.write(json.dumps(record) + "\n")
+            except OSError as e:
+                logging.getLogger("waretomo").warning(
+                    f"Could not save runtime to {self.path}: {e}"
+                )
+
+    def predict(self, features, work):
+        """Predicted runtime in seconds, or None if there is no similar job."""
+        same = [r for r in self.records if r["features"] == features]
+        if same:
+            return statistics.median(r["runtime"] for r in same)
+        kind = [
+            r
+            for r in self.records
+            if r["features"].get("kind") == features.get("kind") and r["work"] > 0
+        ]
+        similar = [
+            r
+            for r in kind
+            if all(
+                r["features"].get(k) == features.get(k) for k in ("patches", "binning")
+            )
+        ]
+        if not (similar or kind):
+            return None
+        return work * statistics.median(
+            r["runtime"] / r["work"] for r in similar or kind
+        )
+
+
+def predict_makespan(jobs, gpus=1, pool=None):
+    """
+    Simulate running the jobs on the given number of gpus, like run_jobs would.
+
+    Uses Job.cost as the runtime of each job; dependencies on jobs which are not
+    part of `jobs` are ignored. Returns the predicted wall-clock time in seconds.
+
+    pool: GpuPool to pack gpu jobs with, by slots and memory, like run_jobs does;
+        by default each of the `gpus` runs one job at a time.
+    """
+    import copy
+
+    from ._gpu import GpuPool
+
+    if pool is None:
+        pool = GpuPool(range(gpus), memory={})
+    else:
+        pool = copy.deepcopy(pool)
+    jobs = list(jobs)
+    included = set(jobs)
+    pending = sorted(jobs, key=lambda job: -job.cost)
+    finished = set()
+    running = []
+    now = 0
+    while pending or running:
+        for job in list(pending):
+            if not all(dep in finished for dep in job.deps if dep in included):
+                continue
+            gpu = None
+            if job.gpu and (gpu := pool.acquire(job.mem)) is None:
+                continue
+            pending.remove(job)
+            heapq.heappush(running, (now + job.cost, id(job), job, gpu))
+        if not running:
+            break
+        now, _, job, gpu = heapq.heappop(running)
+        finished.add(job)
+        if gpu is not None:
+            pool.release(gpu, job.mem)
+    return now
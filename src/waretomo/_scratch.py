@@ -0,0 +1,108 @@
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+
+# leave some room for other users of the scratch disk
+SCRATCH_SAFETY_FACTOR = 0.9
+# how often jobs waiting for space check whether they were cancelled
+RESERVE_POLL_INTERVAL = 1
+
+
+class Scratch:
+    """
+    Node-local staging area for job inputs and outputs.
+
+    Each job gets its own directory inside `root`, where its inputs are copied
+    before it starts; outputs are then copied back to their final location with
+    `copy_back`. The total size of the staged data is capped at `capacity` bytes
+    (default: most of the free space in `root`); jobs wait in `stage` until
+    enough space is released by others, or until they are cancelled.
+    """
+
+    def __init__(self, root, capacity=None):
+        root = Path(root)
+        root.mkdir(parents=True, exist_ok=True)
+        self.root = Path(tempfile.mkdtemp(prefix="waretomo_", dir=root))
+        if capacity is None:
+            capacity = shutil.disk_usage(root).free * SCRATCH_SAFETY_FACTOR
+        self.capacity = capacity
+        self.used = 0
+        self.sizes = {}
+        self.closed = False
+        self._cond = threading.Condition()
+
+    def _reserve(self, size, cancelled=None):
+        with self._cond:
+            # a single job always gets a chance, even if it is too big
+            while not self._cond.wait_for(
+                lambda: not self.used or self.used + size <= self.capacity,
+                timeout=RESERVE_POLL_INTERVAL,
+            ):
+                if self.closed or (cancelled is not None and cancelled.is_set()):
+                    raise InterruptedError("cancelled while waiting for scratch space")
+            self.used += size
+
+    def _release(self, size):
+        with self._cond:
+            self.used -= size
+            self._cond.notify_all()
+
+    def stage(self, inputs, output_size=0, cancelled=None):
+        """
+        Copy inputs to a new job directory, and return its path.
+
+        output_size: estimated size (bytes) of the outputs the job will write there.
+        cancelled: threading.Event, to stop waiting for space.
+        """
+        inputs = [Path(path) for path in inputs if path is not None]
+        size = sum(path.stat().st_size for path in inputs) + output_size
+        self._reserve(size, cancelled)
+        try:
+            job_dir = Path(tempfile.mkdtemp(dir=self.root))
+            for path in inputs:
+                shutil.copyfile(path, job_dir / path.name)
+        except BaseException:
+            self._release(size)
+            raise
+        with self._cond:
+            self.sizes[job_dir] = size
+        return job_dir
+
+    def copy_back(self, job_dir, dest, exclude=()):
+        """
+        Copy everything in job_dir (except `exclude`) to the same place in dest.
+
+        Files are copied under a temporary name and checked before being moved
+        in place, so a partial copy never looks like a finished output.
+        """
+        for src in sorted(job_dir.rglob("*")):
+            rel = src.relative_to(job_dir)
+            if src.is_dir() or str(rel) in exclude:
+                continue
+            target = dest / rel
+            target.parent.mkdir(parents=True, exist_ok=True)
+            tmp = target.with_name(f".{target.name}.waretomo-tmp")
+            shutil.copyfile(src, tmp)
+            if tmp.stat().st_size != src.stat().st_size:
+                tmp.unlink(missing_ok=True)
+                raise OSError(f"copying {src} to {target} failed: size mismatch")
+            os.replace(tmp, target)
+
+    def cleanup(self, job_dir):
+        shutil.rmtree(job_dir, ignore_errors=True)
+        with self._cond:
+            size = self.sizes.pop(job_dir, 0)
+        self._release(size)
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+        if self.sizes:
+            logging.getLogger("waretomo").warning(
+                f"Removing {len(self.sizes)} unfinished job directories "
+                f"from scratch ({self.root})"
+            )
+        shutil.rmtree(self.root, ignore_errors=True)
@@ -1,32 +1,114 @@
+import asyncio
 import logging
+import os
 import shutil
-import subprocess
-from time import sleep
+from functools import partial
 
-from ._threaded import run_threaded
+import mrcfile
+import numpy as np
 
+from ._cache import check_up_to_date, describe_job, partial_path, write_manifest
+from ._threaded import Job, run_jobs, run_streamed
 
-def _stack(images, output, cmd="newstack", dry_run=False, overwrite=False):
-    if not overwrite and output.exists():
-        raise FileExistsError(output)
-    stack_cmd = f'{cmd} {" ".join(str(img) for img in images)} {output}'
+
+def _write_stack(images, output):
+    """
+    Stack 2D mrc images into a new mrc file, like newstack would.
+
+    The output is preallocated and memory-mapped, and each image is copied
+    straight from its own memory map into it. Header statistics are accumulated
+    per section, from the section just written (still in the page cache), so
+    the output is not read back from disk at the end.
+    """
+    with mrcfile.mmap(images[0], permissive=True) as first:
+        ny, nx = first.data.shape[-2:]
+        mode = first.header.mode
+        voxel_size = first.voxel_size.copy()
+        origin = first.header.origin.copy()
+
+    mins = np.empty(len(images))
+    maxs = np.empty(len(images))
+    means = np.empty(len(images))
+    variances = np.empty(len(images))
+    with mrcfile.new_mmap(
+        output, shape=(len(images), ny, nx), mrc_mode=mode, overwrite=True
+    ) as mrc:
+        for i, img in enumerate(images):
+            with mrcfile.mmap(img, permissive=True) as section:
+                if section.data.shape[-2:] != (ny, nx):
+                    raise ValueError(f"{img} has a different shape from {images[0]}")
+                mrc.data[i] = section.data.reshape(ny, nx)
+            data = mrc.data[i]
+            mins[i] = data.min()
+            maxs[i] = data.max()
+            means[i] = data.mean(dtype=np.float64)
+            variances[i] = data.var(dtype=np.float64)
+
+        # all sections have the same size, so we can combine them directly
+        mean = means.mean()
+        mrc.header.dmin = mins.min()
+        mrc.header.dmax = maxs.max()
+        mrc.header.dmean = mean
+        mrc.header.rms = np.sqrt((variances + (means - mean) ** 2).mean())
+        mrc.set_image_stack()
+        # like imod, which keeps the sampling in z equal to the number of sections
+        mrc.header.mz = len(images)
+        mrc.voxel_size = voxel_size
+        mrc.header.origin = origin
+        mrc.add_label(f"waretomo: stacked {len(images)} sections")
+
+
+async def _stack(images, output, cmd=None, dry_run=False, overwrite=False):
+    description = describe_job(images, {})
+    if not overwrite:
+        check_up_to_date(output, description)
 
     log = logging.getLogger("waretomo")
-    short_cmd = f"{cmd} {images[0]} [...] {images[-1]} {output}"
+    short_cmd = f"{cmd or 'stack'} {images[0]} [...] {images[-1]} {output}"
     log.info(short_cmd)
 
     if not dry_run:
-        subprocess.run(stack_cmd.split(), capture_output=True, check=True)
+        tmp = partial_path(output)
+        if cmd is None:
+            await asyncio.to_thread(_write_stack, images, tmp)
+        else:
+            stack_cmd = f'{cmd} {" ".join(str(img) for img in images)} {tmp}'
+            await run_streamed(stack_cmd.split())
+        os.replace(tmp, output)
+        write_manifest(output, description)
     else:
-        sleep(0.1)
+        await asyncio.sleep(0.1)
+
 
+def half_stack_jobs(tilt_series, half, cmd=None, dry_run=False, overwrite=False):
+    """
+    Generate jobs stacking odd/even averages for each tilt series.
 
-def prepare_half_stacks(progress, tilt_series, half, cmd="newstack", **kwargs):
-    if not shutil.which(cmd):
+    If cmd is None, use the built-in stack writer; otherwise cmd is a
+    newstack-compatible executable.
+    """
+    if cmd is not None and not shutil.which(cmd):
         raise FileNotFoundError(f"{cmd} is not available on the system")
 
-    partials = [
-        lambda ts=ts: _stack(ts[half], ts[f"stack_{half}"], cmd=cmd, **kwargs)
+    return [
+        Job(
+            partial(
+                _stack,
+                ts[half],
+                ts[f"stack_{half}"],
+                cmd=cmd,
+                dry_run=dry_run,
+                overwrite=overwrite,
+            ),
+            label=f"Stacking {half} halves",
+            name=ts["name"],
+            inputs=ts[half],
+            outputs=[ts[f"stack_{half}"]],
+        )
         for ts in tilt_series
     ]
-    run_threaded(progress, partials, label=f"Stacking {half} halves", **kwargs)
+
+
+def prepare_half_stacks(progress, tilt_series, half, cmd=None, **kwargs):
+    jobs = half_stack_jobs(tilt_series, half=half, cmd=cmd, **kwargs)
+    run_jobs(progress, jobs, **kwargs)
@@ -1,54 +1,509 @@
+import asyncio
 import logging
 import os
+import re
+import signal
 import subprocess
+import threading
+import time
+from collections import deque
 from concurrent import futures
+from functools import partial
 
+from ._gpu import GpuPool, is_out_of_memory
+from ._queue import job_key
 
-def run_threaded(
+# number of output lines kept in memory for error reports
+TAIL_LINES = 200
+# processes started by run_streamed, so they can be killed if we are interrupted
+# (its own task kills each of them when cancelled, this is a last resort)
+_procs = set()
+_procs_lock = threading.Lock()
+# most tools report progress as "N of M" or "N/M"
+PROGRESS_RE = re.compile(rb"(\d+)\s*(?:of|/)\s*(\d+)")
+# seconds between checks on jobs claimed by other workers
+QUEUE_POLL_INTERVAL = 5
+
+
+class Job:
+    """
+    A single unit of work in the processing graph.
+
+    fn: callable to run; if gpu is True, it will be called with a `gpu` kwarg.
+        Coroutine functions (e.g. running commands with run_streamed) are run
+        directly in the event loop, other callables in a thread pool.
+    label: name of the processing step, used to group progress bars
+    gpu: whether this job needs a gpu slot for itself
+    mem: estimated gpu memory usage in MB, used to pack jobs on gpus
+    cost: estimated runtime in seconds; among ready jobs, costlier ones start first
+    track: whether fn reports its own progress; if True, it will be called with
+        an `update` kwarg, which takes the same arguments as `Progress.update`
+    deps: other jobs that need to finish successfully before this one can start
+    inputs, outputs: files read and written by the job, for the timing trace
+    features, work: what the runtime depends on, and an estimate of the amount of
+        work, for the runtime history; jobs without features are not recorded
+    pinned_to: with a WorkQueue, this job is claimed together with the given job,
+        so they run on the same worker (e.g. to copy back results staged on it)
+    """
+
+    def __init__(
+        self,
+        fn,
+        label="",
+        name="",
+        gpu=False,
+        mem=0,
+        cost=0,
+        track=False,
+        deps=(),
+        inputs=(),
+        outputs=(),
+        features=None,
+        work=0,
+        pinned_to=None,
+    ):
+        self.fn = fn
+        self.label = label
+        self.name = name
+        self.gpu = gpu
+        self.mem = mem
+        self.cost = cost
+        self.track = track
+        self.deps = [dep for dep in deps if dep is not None]
+        self.inputs = [path for path in inputs if path is not None]
+        self.outputs = [path for path in outputs if path is not None]
+        self.features = features
+        self.work = work
+        self.pinned_to = pinned_to
+
+    def __repr__(self):
+        """Repr."""
+        return f"Job({self.label!r}, {self.name!r})"
+
+
+async def _timed(fn, times, **kwargs):
+    times.append(time.time())
+    try:
+        if asyncio.iscoroutinefunction(fn):
+            return await fn(**kwargs)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, partial(fn, **kwargs))
+    finally:
+        times.append(time.time())
+
+
+def run_jobs(
     progress,
-    partials,
-    label="",
+    jobs,
+    gpus=(),
+    gpu_slots=1,
+    retries=0,
     max_workers=None,
+    tracer=None,
+    queue=None,
+    history=None,
+    journal=None,
     dry_run=False,
     **kwargs,
+):
+    """
+    Run a graph of jobs as soon as their dependencies are satisfied.
+
+    Jobs are scheduled by a single asyncio event loop: external commands run as
+    asyncio subprocesses, so they don't need a thread each, while other jobs run
+    in a thread pool of `max_workers` threads. On interruption, running jobs are
+    cancelled, which kills their processes (see run_streamed).
+
+    Cpu jobs run at most `max_workers` at a time; gpu jobs are only started
+    when a gpu from `gpus` has a free slot (see GpuPool), and the gpu id is passed
+    to them directly. Gpu jobs which run out of memory are retried once the gpu
+    is less busy. Gpu jobs which fail or time out are retried up to `retries`
+    times, on a different gpu if possible. Jobs whose dependencies failed are not
+    run at all.
+
+    Ready jobs are started longest first (see Job.cost), so short jobs fill the
+    gaps at the end instead of a long one keeping a single gpu busy alone.
+
+    If a Tracer is given, each attempt at running a job is recorded in it.
+    If a RuntimeHistory is given, the runtime of successful jobs is recorded in
+    it, unless they shared their gpu with other jobs (which slows them down).
+    If a Journal is given, the start and end of each job is recorded in it.
+
+    If a WorkQueue is given, jobs are claimed in it before running, so that other
+    workers sharing the queue do not run them too; jobs claimed by others are
+    waited for, so that jobs depending on them can run here afterwards.
+    """
+    return asyncio.run(
+        _run_jobs(
+            progress,
+            jobs,
+            gpus=gpus,
+            gpu_slots=gpu_slots,
+            retries=retries,
+            max_workers=max_workers,
+            tracer=tracer,
+            queue=queue,
+            history=history,
+            journal=journal,
+            dry_run=dry_run,
+        )
+    )
+
+
+async def _run_jobs(
+    progress,
+    jobs,
+    gpus=(),
+    gpu_slots=1,
+    retries=0,
+    max_workers=None,
+    tracer=None,
+    queue=None,
+    history=None,
+    journal=None,
+    dry_run=False,
 ):
     max_workers = max_workers or min(32, os.cpu_count() + 4)  # see concurrent docs
 
     log = logging.getLogger("waretomo")
 
-    with futures.ThreadPoolExecutor(max_workers) as executor:
-        main_task = progress.add_task(f"{label}...", total=len(partials))
-
-        jobs = []
-        for fn in partials:
-            job = executor.submit(fn)
-            jobs.append(job)
-
-        tasks = []
-        for i, _thread in enumerate(executor._threads):
-            tasks.append(progress.add_task(f"thread #{i}...", start=False))
-
-        exist = 0
-        errors = []
-        for job in futures.as_completed(jobs):
-            try:
-                job.result()
-            except FileExistsError:
-                exist += 1
-            except subprocess.CalledProcessError as e:
-                errors.append(e)
-                log.warning("Subprocess failed with:")
-            progress.update(main_task, advance=1)
-
-        for t in tasks:
-            progress.update(t, total=1, completed=1, visible=False)
-
-        if exist:
-            log.warn(f"{label}: {exist} files already exist and were not overwritten")
-
-        if errors:
-            log.error(f"{label}: {len(errors)} commands have failed:")
-            for err in errors:
-                log.error(
-                    f'{" ".join(err.cmd)} ' f"failed with:\n{err.stderr.decode()}"
-                )
+    if any(job.gpu for job in jobs) and not gpus:
+        raise RuntimeError("gpu jobs were requested, but no gpus are available")
+    gpu_pool = GpuPool(gpus, slots=gpu_slots)
+
+    # one progress bar per processing step
+    totals = {}
+    for job in jobs:
+        totals[job.label] = totals.get(job.label, 0) + 1
+    main_tasks = {
+        label: progress.add_task(f"{label}...", total=total)
+        for label, total in totals.items()
+    }
+
+    # stable, so jobs with the same cost keep the order of the graph
+    pending = sorted(jobs, key=lambda job: -job.cost)
+    running = {}
+    # gpu jobs which shared their gpu with others at some point, and the
+    # maximum number of jobs per gpu at the time they were started
+    shared = set()
+    started_with = {}
+    # per-job progress bars, for jobs that report their own progress
+    job_tasks = {}
+    # number of failures of each job so far, and the gpus it failed on
+    failures = {}
+    failed_on = {}
+    # gpus which are only to blame if the job then works on another one
+    suspects = {}
+    # when each job became ready to run, and when it actually started/ended
+    ready = {}
+    times = {}
+    state = {}
+    exist = {}
+    elsewhere = {}
+    errors = {}
+    # when jobs claimed by other workers were last checked on
+    polled = {}
+    # jobs which must run on the same worker as the one they are pinned to
+    pinned = {}
+    for job in jobs:
+        if job.pinned_to is not None:
+            pinned.setdefault(job.pinned_to, []).append(job)
+    # also used by gpu jobs for blocking work, such as staging inputs in scratch
+    executor = futures.ThreadPoolExecutor(max_workers + gpu_pool.total_slots)
+    asyncio.get_running_loop().set_default_executor(executor)
+    try:
+        while pending or running:
+            cpu_running = sum(not job.gpu for job, _ in running.values())
+            # whether some jobs are waiting for other workers
+            waiting = False
+            # whether some jobs were settled without running, which may have made
+            # others (earlier in the list) ready
+            settled = False
+            for job in list(pending):
+                if any(state.get(dep) == "failed" for dep in job.deps):
+                    settled = True
+                    pending.remove(job)
+                    state[job] = "failed"
+                    log.warning(f"{job.label}: skipping {job.name} (upstream failure)")
+                    progress.advance(main_tasks[job.label])
+                    continue
+                if not all(dep in state for dep in job.deps):
+                    continue
+                if (
+                    queue is not None
+                    and time.monotonic() - polled.get(job, -QUEUE_POLL_INTERVAL)
+                    < QUEUE_POLL_INTERVAL
+                ):
+                    # claimed by another worker, no need to ask again so soon
+                    waiting = True
+                    continue
+                ready.setdefault(job, time.time())
+                fn_kwargs = {}
+                if job.gpu:
+                    gpu = gpu_pool.acquire(job.mem, avoid=failed_on.get(job, ()))
+                    if gpu is None:
+                        continue
+                    fn_kwargs["gpu"] = gpu
+                else:
+                    if cpu_running >= max_workers:
+                        continue
+                    gpu = None
+                    cpu_running += 1
+                if queue is not None:
+                    # only asked once resources are free, to spare the file system
+                    claim = queue.claim(job_key(job))
+                    if claim is None:
+                        if gpu is None:
+                            cpu_running -= 1
+                        else:
+                            gpu_pool.release(gpu, job.mem)
+                        remote = queue.status(job_key(job))
+                        if remote in ("done", "failed"):
+                            settled = True
+                            pending.remove(job)
+                            ready.pop(job)
+                            state[job] = remote
+                            elsewhere[job.label] = elsewhere.get(job.label, 0) + 1
+                            progress.advance(main_tasks[job.label])
+                        else:
+                            polled[job] = time.monotonic()
+                            waiting = True
+                        continue
+                    for follower in pinned.get(job, ()):
+                        # e.g. results staged on this node can only be copied here
+                        queue.claim(job_key(follower))
+                    if claim == "recovered":
+                        # whatever the dead worker left behind can't be trusted
+                        for output in job.outputs:
+                            output.unlink(missing_ok=True)
+                if job.track:
+                    task = progress.add_task(f"  {job.name}", total=None)
+                    fn_kwargs["update"] = partial(progress.update, task)
+                if journal is not None:
+                    journal.record("started", job_key(job), job.outputs)
+                job_times = []
+                future = asyncio.ensure_future(_timed(job.fn, job_times, **fn_kwargs))
+                times[future] = job_times
+                if job.track:
+                    job_tasks[future] = task
+                pending.remove(job)
+                if gpu is not None:
+                    neighbours = [f for f, (_, g) in running.items() if g == gpu]
+                    if neighbours:
+                        shared.update(neighbours)
+                        shared.add(future)
+                    started_with[future] = gpu_pool.max_slots[gpu]
+                running[future] = (job, gpu)
+
+            if not running and settled:
+                continue
+            if not running and waiting:
+                await asyncio.sleep(QUEUE_POLL_INTERVAL)
+                continue
+            if not running:
+                # nothing can run anymore (should not happen with a proper graph)
+                for job in pending:
+                    log.error(f"{job.label}: {job.name} has unsatisfiable dependencies")
+                break
+
+            done, _ = await asyncio.wait(
+                running,
+                timeout=QUEUE_POLL_INTERVAL if waiting else None,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            for future in done:
+                job, gpu = running.pop(future)
+                if future in job_tasks:
+                    progress.remove_task(job_tasks.pop(future))
+                was_shared = future in shared
+                shared.discard(future)
+                slots = started_with.pop(future, None)
+                status = "failed"
+                try:
+                    future.result()
+                except (
+                    subprocess.CalledProcessError,
+                    subprocess.TimeoutExpired,
+                ) as e:
+                    if (
+                        was_shared
+                        and is_out_of_memory(e)
+                        and gpu_pool.back_off(gpu, slots)
+                    ):
+                        # try again later, with fewer jobs sharing the gpu
+                        status = "out of memory, requeued"
+                        pending.insert(0, job)
+                        continue
+                    if gpu is not None:
+                        failed_on.setdefault(job, set()).add(gpu)
+                        if _blames_gpu(e):
+                            gpu_pool.report(gpu, success=False)
+                        else:
+                            suspects.setdefault(job, []).append(gpu)
+                        failures[job] = failures.get(job, 0) + 1
+                        if failures[job] <= retries:
+                            log.warning(
+                                f"{job.label}: {job.name} failed on GPU {gpu}, "
+                                "retrying..."
+                            )
+                            status = "failed, retried"
+                            pending.insert(0, job)
+                            continue
+                    errors.setdefault(job.label, []).append(e)
+                    state[job] = "failed"
+                    log.warning(f"{job.label}: subprocess failed for {job.name}")
+                except FileExistsError:
+                    exist[job.label] = exist.get(job.label, 0) + 1
+                    state[job] = status = "exists"
+                except Exception as e:
+                    # e.g: corrupted inputs; only this job and its dependents fail
+                    errors.setdefault(job.label, []).append(e)
+                    state[job] = "failed"
+                    log.warning(f"{job.label}: {job.name} failed: {e!r}")
+                else:
+                    state[job] = status = "done"
+                    if gpu is not None:
+                        for suspect in suspects.pop(job, ()):
+                            if suspect != gpu:
+                                gpu_pool.report(suspect, success=False)
+                        gpu_pool.report(gpu, success=True)
+                    if (
+                        history is not None
+                        and job.features
+                        and not was_shared
+                        and not dry_run
+                    ):
+                        start, end = times[future]
+                        history.record(job.features, job.work, end - start)
+                finally:
+                    if gpu is not None:
+                        gpu_pool.release(gpu, job.mem)
+                    job_times = times.pop(future)
+                    queued = ready.pop(job)
+                    if tracer is not None and len(job_times) == 2:
+                        tracer.record(
+                            job.name,
+                            job.label,
+                            queued,
+                            *job_times,
+                            resource="CPU" if gpu is None else f"GPU {gpu}",
+                            status=status,
+                            inputs=job.inputs,
+                            outputs=job.outputs,
+                        )
+                result = "failed" if state[job] == "failed" else "done"
+                if journal is not None:
+                    journal.record(result, job_key(job))
+                if queue is not None:
+                    queue.finish(job_key(job), status=result)
+                progress.advance(main_tasks[job.label])
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        # don't leave orphan processes hogging the gpus
+        log.error("Interrupted! Killing running jobs...")
+        for future in running:
+            future.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+        kill_all()
+        raise
+
+    for label, n in exist.items():
+        log.warning(f"{label}: {n} outputs are already up to date")
+
+    for label, n in elsewhere.items():
+        log.warning(f"{label}: {n} jobs were processed by other workers")
+
+    for label, errs in errors.items():
+        log.error(f"{label}: {len(errs)} commands have failed:")
+        for err in errs:
+            if isinstance(err, subprocess.SubprocessError):
+                output = (err.stdout or b"") + (err.stderr or b"")
+                cmd = " ".join(str(c) for c in err.cmd)
+                log.error(f"{cmd} failed with:\n{output.decode(errors='replace')}")
+            else:
+                log.error(f"{err!r}")
+
+    return state
+
+
+def _blames_gpu(err):
+    """Whether a failed command points to a gpu problem, rather than to its inputs."""
+    # hung, or killed by a signal (e.g. a crashing driver); bad inputs make
+    # commands exit with an error code instead
+    return isinstance(err, subprocess.TimeoutExpired) or err.returncode < 0
+
+
+def kill(proc):
+    """Kill a process started by run_streamed, together with its children."""
+    if os.name == "posix":
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+    else:
+        proc.kill()
+
+
+def kill_all():
+    """Kill all the processes currently started by run_streamed."""
+    with _procs_lock:
+        procs = list(_procs)
+    for proc in procs:
+        kill(proc)
+
+
+async def run_streamed(cmd, log_file=None, update=None, timeout=None, **kwargs):
+    """
+    Run a command as an asyncio subprocess, streaming its output to log_file.
+
+    Progress is parsed from each line and reported through `update`, if given.
+    Only the last few lines are kept in memory, to be reported on failure.
+    If the command runs for longer than `timeout` seconds, or if the task running
+    it is cancelled, it is killed together with its children.
+    """
+    tail = deque(maxlen=TAIL_LINES)
+    # run in a separate process group, so we can kill any children with it
+    if os.name == "posix":
+        kwargs.setdefault("start_new_session", True)
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        # some tools print very long lines without newlines (e.g. progress bars)
+        limit=2**20,
+        **kwargs,
+    )
+    with _procs_lock:
+        _procs.add(proc)
+
+    async def _stream(log):
+        async for line in proc.stdout:
+            if log is not None:
+                log.write(line)
+            tail.append(line)
+            if update is not None and (match := PROGRESS_RE.search(line)):
+                completed, total = int(match[1]), int(match[2])
+                if 0 < total and completed <= total:
+                    update(completed=completed, total=total)
+        await proc.wait()
+
+    try:
+        log = open(log_file, "wb") if log_file is not None else None
+        try:
+            await asyncio.wait_for(_stream(log), timeout)
+        finally:
+            if log is not None:
+                log.close()
+    except asyncio.TimeoutError:
+        kill(proc)
+        await proc.wait()
+        raise subprocess.TimeoutExpired(cmd, timeout, output=b"".join(tail)) from None
+    except BaseException:
+        # cancelled (e.g: ctrl+c): don't leave orphans behind
+        kill(proc)
+        await asyncio.shield(proc.wait())
+        raise
+    finally:
+        with _procs_lock:
+            _procs.discard(proc)
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, output=b"".join(tail))
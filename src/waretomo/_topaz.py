@@ -1,43 +1,377 @@
-import contextlib
 import io
 import logging
 import multiprocessing
-import re
+import os
+import shutil
+import sys
 import time
-from concurrent import futures
+from functools import partial
+from queue import Empty, Queue
+from threading import Thread
 
-from topaz.commands.denoise3d import denoise, load_model, set_device, train_model
-from topaz.torch import set_num_threads
+from ._cache import check_up_to_date, describe_job, partial_path, write_manifest
 
+# torch and topaz take seconds to import, so they are only imported by the
+# functions that need them, once we know there is something to denoise
 
-def _run_and_update_progress(progress, task, func, *args, **kwargs):
-    std = io.StringIO()
+# torch threads per denoising worker when running on cpu
+CPU_THREADS_PER_WORKER = 8
+# minimum fraction of a tomogram between two progress reports from a worker
+PROGRESS_STEP = 0.01
+OUT_OF_MEMORY = (
+    "Not enough GPU memory. Try to lower --topaz-tile-size or --topaz-patch-size"
+)
+# mrc: float32 like topaz; mrc-float16: half the size (mode 12);
+# ome-zarr: chunked, compressed and multiscale, so viewers can load it lazily
+OUTPUT_FORMATS = ("mrc", "mrc-float16", "ome-zarr")
+ZARR_CHUNK_SIZE = 64
 
-    def _run_with_redirection():
-        with contextlib.redirect_stderr(std):
-            func(*args, **kwargs)
 
-    with futures.ThreadPoolExecutor(1) as executor:
-        job = executor.submit(_run_with_redirection)
+def _read_volume(path):
+    import numpy as np
+    from topaz import mrc
 
-        last_read_pos = 0
-        while not job.done():
-            time.sleep(0.5)
-            std.seek(last_read_pos)
-            last = std.read()
-            if match := re.search(r"(\d+\.\d+)%", last):
-                last_read_pos = std.tell()
-                progress.update(task, completed=float(match.group(1)), refresh=True)
+    with open(path, "rb") as f:
+        content = f.read()
+    tomo, header, extended_header = mrc.parse(content)
+    return tomo.astype(np.float32), header, extended_header
+
+
+def _output_path(outdir, path, output_format="mrc"):
+    if output_format == "ome-zarr":
+        return outdir / (path.stem + ".zarr")
+    return outdir / path.name
+
+
+def _downsample(volume):
+    """Bin a volume by 2 along each axis (dropping odd edges), like a pyramid level."""
+    z, y, x = (size // 2 for size in volume.shape)
+    binned = volume[: z * 2, : y * 2, : x * 2].reshape(z, 2, y, 2, x, 2)
+    return binned.mean(axis=(1, 3, 5), dtype="float32").astype(volume.dtype)
+
+
+def _write_zarr(path, volume, header):
+    """
+    Write a volume as OME-Zarr (v0.4), with a pyramid of binned copies of it.
+
+    Levels are computed from the volume in memory while writing, so the data is
+    never read back.
+    """
+    import zarr
+
+    # unknown voxel sizes are 0 in mrc, but scales must be positive
+    voxel_size = [
+        length / n if n and length > 0 else 1.0
+        for length, n in (
+            (header.zlen, header.mz),
+            (header.ylen, header.my),
+            (header.xlen, header.mx),
+        )
+    ]
+    tmp = partial_path(path)
+    shutil.rmtree(tmp, ignore_errors=True)
+    root = zarr.open_group(str(tmp), mode="w")
+    datasets = []
+    level = volume
+    while True:
+        name = str(len(datasets))
+        # default compressor (blosc)
+        root.create_dataset(name, data=level, chunks=(ZARR_CHUNK_SIZE,) * 3)
+        binning = 2 ** len(datasets)
+        transforms = [{"type": "scale", "scale": [s * binning for s in voxel_size]}]
+        if binning > 1:
+            # binned voxels are centered between the voxels they were made from
+            translation = [s * (binning - 1) / 2 for s in voxel_size]
+            transforms.append({"type": "translation", "translation": translation})
+        datasets.append({"path": name, "coordinateTransformations": transforms})
+        if max(level.shape) <= ZARR_CHUNK_SIZE or min(level.shape) < 2:
+            break
+        level = _downsample(level)
+    root.attrs["multiscales"] = [
+        {
+            "version": "0.4",
+            "name": path.stem,
+            "axes": [
+                {"name": axis, "type": "space", "unit": "angstrom"} for axis in "zyx"
+            ],
+            "datasets": datasets,
+        }
+    ]
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp, path)
+
+
+def _write_volume(path, volume, header, extended_header, output_format="mrc"):
+    import numpy as np
+    from topaz import mrc
+
+    if output_format == "ome-zarr":
+        _write_zarr(path, volume, header)
+        return
+
+    if output_format == "mrc-float16":
+        limit = np.finfo(np.float16).max
+        volume = np.clip(volume, -limit, limit).astype(np.float16)
+    # same as topaz: keep the input header, except for mode and stats
+    header = header._replace(
+        mode=12 if volume.dtype == np.float16 else 2,
+        amin=volume.min(),
+        amax=volume.max(),
+        amean=volume.mean(dtype=np.float32),
+    )
+    tmp = partial_path(path)
+    with open(tmp, "wb") as f:
+        if volume.dtype == np.float16:
+            # topaz can only write float32
+            f.write(mrc.header_struct.pack(*header))
+            f.write(extended_header)
+            f.write(volume.tobytes())
+        else:
+            mrc.write(f, volume, header=header, extended_header=extended_header)
+    os.replace(tmp, path)
+
+
+def _is_out_of_memory(e):
+    return "CUDA out of memory." in str(e)
+
+
+def _train_model(
+    even,
+    odd,
+    save_prefix,
+    device,
+    tile_size,
+    update=None,
+    num_epochs=500,
+    save_interval=10,
+    minibatch_size=10,
+    n_train=1000,
+    n_test=200,
+    learning_rate=0.001,
+    num_workers=1,
+    max_memory=None,
+):
+    """
+    Train a topaz denoising model (same as topaz's train_model, adagrad and L2 loss).
+
+    Progress is reported through `update`, which takes the same arguments
+    as `Progress.update`, after each minibatch.
+
+    Tiles are read lazily from memory-mapped half tomograms; `max_memory` (MB)
+    limits how much of them is mapped at a time, across all dataloader workers.
+    """
+    import torch
+    from topaz.commands.denoise3d import save_model, set_device
+    from topaz.denoise import UDenoiseNet3D
+    from torch import nn
+
+    from ._training import HalfTomogramPatches
+
+    log = logging.getLogger("waretomo")
+    if save_prefix is not None:
+        os.makedirs(os.path.dirname(save_prefix), exist_ok=True)
+    device_log = io.StringIO()
+    model_base = UDenoiseNet3D(base_width=11)
+    model, use_cuda, _ = set_device(model_base, device, log=device_log)
+    if device_log.getvalue():
+        log.info(device_log.getvalue().strip())
+    cost_func = nn.MSELoss()
+    optim = torch.optim.Adagrad(model.parameters(), lr=learning_rate)
+
+    max_mapped = None
+    if max_memory is not None:
+        max_mapped = max_memory * 2**20 // max(1, num_workers)
+    data = HalfTomogramPatches(
+        even, odd, tile_size, n_train, n_test, max_mapped=max_mapped
+    )
+    batches = torch.utils.data.DataLoader(
+        data, batch_size=minibatch_size, num_workers=num_workers, shuffle=False
+    )
+    data.set_mode("train")
+    n_batches = len(batches)
+    digits = len(str(num_epochs))
+
+    for epoch in range(num_epochs):
+        for mode in ("train", "test"):
+            data.set_mode(mode)
+            model.train(mode == "train")
+            loss_accum = 0
+            seen = 0
+            with torch.set_grad_enabled(mode == "train"):
+                for batch, (source, target) in enumerate(batches):
+                    if use_cuda:
+                        source = source.cuda()
+                        target = target.cuda()
+                    loss = cost_func(model(source), target)
+                    if mode == "train":
+                        loss.backward()
+                        optim.step()
+                        optim.zero_grad()
+                    # running mean of the loss, weighted by batch size
+                    seen += len(source)
+                    loss_accum += len(source) * (loss.item() - loss_accum) / seen
+                    if mode == "train" and update is not None:
+                        update(
+                            completed=epoch + (batch + 1) / n_batches,
+                            total=num_epochs,
+                            description=f"Training (loss: {loss_accum:.5f})...",
+                        )
+            log.debug(f"epoch {epoch + 1}/{num_epochs}: {mode} loss {loss_accum}")
+
+        if save_prefix is not None and (epoch + 1) % save_interval == 0:
+            model.eval().cpu()
+            save_model(model, epoch + 1, save_prefix, digits=digits)
+            if use_cuda:
+                model.cuda()
+
+    return model_base
+
+
+def _denoise_volume(model, tomo, patch_size, update=None):
+    """
+    Denoise a whole volume in overlapping patches (see topaz's denoise).
+
+    If given, `update(completed=, total=)` is called after each patch.
+    """
+    import numpy as np
+    import torch
+    from topaz.commands.denoise3d import PatchDataset
+
+    padding = patch_size // 2
+    mu = tomo.mean()
+    std = tomo.std()
+    device = next(iter(model.parameters())).device
+    denoised = np.zeros_like(tomo)
+    patches = torch.utils.data.DataLoader(
+        PatchDataset(tomo, patch_size, padding), batch_size=1
+    )
+    with torch.no_grad():
+        for count, (index, x) in enumerate(patches, 1):
+            x = (x.to(device) - mu) / std
+            x = model(x.unsqueeze(1)).squeeze(1).cpu().numpy()
+            x = std * x + mu
+            for (i, j, k), xb in zip(index.tolist(), x):
+                patch = denoised[
+                    i : i + patch_size, j : j + patch_size, k : k + patch_size
+                ]
+                pz, py, px = patch.shape
+                patch[:] = xb[
+                    padding : padding + pz,
+                    padding : padding + py,
+                    padding : padding + px,
+                ]
+            if update is not None:
+                update(completed=count, total=len(patches))
+    return denoised
+
+
+def _denoise_worker(
+    model_name,
+    device,
+    num_threads,
+    outdir,
+    patch_size,
+    queue_depth,
+    output_format,
+    todo,
+    results,
+):
+    """
+    Denoise tomograms from the `todo` queue until a None is found.
+
+    Reading and writing happen in background threads, so the device is kept busy
+    while the previous output is written and the next input is read. At most
+    `queue_depth` tomograms wait on each side, to keep memory usage bounded.
+
+    Events are sent to `results` as (path, kind, value) tuples, where kind is
+    "progress" (value is the completed fraction), "done" (value is the wall-clock
+    time when denoising started and when writing the output ended, and the
+    device) or "error" (value is the error message).
+    """
+    # topaz prints while loading models; this process has no terminal to share
+    sys.stdout = sys.stderr = open(os.devnull, "w")
+    try:
+        from topaz.commands.denoise3d import load_model, set_device
+        from topaz.torch import set_num_threads
+
+        set_num_threads(num_threads)
+        model = load_model(model_name, base_kernel_width=11)
+        model.eval()
+        model, _, _ = set_device(model, device)
+    except Exception as e:
+        results.put((None, "error", f"could not load model on device {device}: {e!r}"))
+        return
+
+    loaded = Queue(maxsize=queue_depth)
+    to_write = Queue(maxsize=queue_depth)
+
+    def _reader():
+        while (path := todo.get()) is not None:
+            try:
+                loaded.put((path, _read_volume(path)))
+            except Exception as e:
+                results.put((path, "error", f"could not read {path}: {e!r}"))
+        loaded.put(None)
+
+    def _writer():
+        while (item := to_write.get()) is not None:
+            path, start, volume, header, extended_header = item
+            output = _output_path(outdir, path, output_format)
+            try:
+                _write_volume(output, volume, header, extended_header, output_format)
+            except Exception as e:
+                error = f"could not write {output}: {e!r}"
+                results.put((path, "error", error))
+            else:
+                results.put((path, "done", (start, time.time(), device)))
+
+    reader = Thread(target=_reader, daemon=True)
+    writer = Thread(target=_writer, daemon=True)
+    reader.start()
+    writer.start()
+    while (item := loaded.get()) is not None:
+        path, (tomo, header, extended_header) = item
+        start = time.time()
+        reported = 0
+
+        def _update(completed, total, path=path):
+            nonlocal reported
+            # only send meaningful steps, there can be thousands of patches
+            if completed / total - reported >= PROGRESS_STEP:
+                reported = completed / total
+                results.put((path, "progress", reported))
 
         try:
-            return job.result()
-        except RuntimeError as e:
-            if "CUDA out of memory." in e.args[0]:
-                raise RuntimeError(
-                    "Not enough GPU memory. "
-                    "Try to lower --topaz-tile-size or --topaz-patch-size"
-                ) from e
-            raise
+            denoised = _denoise_volume(model, tomo, patch_size, update=_update)
+        except Exception as e:
+            # e.g. odd-shaped volumes; the next tomograms can still be denoised
+            error = OUT_OF_MEMORY if _is_out_of_memory(e) else repr(e)
+            results.put((path, "error", error))
+            continue
+        del item, tomo
+        to_write.put((path, start, denoised, header, extended_header))
+    to_write.put(None)
+    writer.join()
+
+
+def _get_devices(gpus=None, n_inputs=1):
+    """
+    Decide which devices to use for denoising, and how many threads each worker gets.
+
+    Returns a list with one (device, num_threads) tuple per worker.
+    """
+    import torch
+
+    if torch.cuda.is_available():
+        if gpus is None:
+            gpus = range(torch.cuda.device_count())
+        return [(gpu, 0) for gpu in gpus]
+
+    # on cpu, a few workers with several threads each scale better than one
+    # worker with all the threads, as long as there is enough work for each
+    cpus = os.cpu_count() or 1
+    n_workers = max(1, min(n_inputs, cpus // CPU_THREADS_PER_WORKER))
+    return [(-1, cpus // n_workers)] * n_workers
 
 
 def topaz_batch(
@@ -50,13 +384,46 @@ def topaz_batch(
     train=False,
     tile_size=32,
     patch_size=32,
+    queue_depth=1,
+    train_memory=None,
+    output_format="mrc",
     gpus=None,
+    tracer=None,
     dry_run=False,
     overwrite=False,
 ):
     inputs = [ts["recon"] for ts in tilt_series]
+    outputs = {path: _output_path(outdir, path, output_format) for path in inputs}
 
     log = logging.getLogger("waretomo")
+
+    # a freshly trained model invalidates all previous outputs
+    descriptions = {
+        path: describe_job(
+            [path],
+            {
+                "model": model_name,
+                "train": train,
+                "patch_size": patch_size,
+                # only if needed, so outputs from before formats existed stay valid
+                **({"format": output_format} if output_format != "mrc" else {}),
+            },
+        )
+        for path in inputs
+    }
+    if not overwrite and not train:
+        exist = 0
+        for path in list(inputs):
+            try:
+                check_up_to_date(outputs[path], descriptions[path])
+            except FileExistsError:
+                inputs.remove(path)
+                exist += 1
+        if exist:
+            log.warning(f"Denoising: {exist} files already exist and are up to date")
+        if not inputs:
+            return []
+
     if train:
         log.info(f"training model: '{model_name}' with inputs '{even}' and '{odd}'")
     if len(inputs) > 2:
@@ -66,44 +433,132 @@ def topaz_batch(
     log.info(f"output: {outdir}")
 
     if not dry_run:
+        import torch
+        from topaz.torch import set_num_threads
+
         set_num_threads(0)
-        std = io.StringIO()
         if train:
             task = progress.add_task(description="Training...")
-            model, _ = _run_and_update_progress(
-                progress,
-                task,
-                train_model,
-                even_path=even,
-                odd_path=odd,
-                save_prefix=str(outdir / "trained_models" / model_name),
-                save_interval=10,
-                device=(
-                    -2 if gpus is None else next(iter(gpus))
-                ),  # TODO: actually run with multiple gpus?
-                tilesize=patch_size,
-                base_kernel_width=11,
-                num_workers=multiprocessing.cpu_count(),
-            )
-        else:
-            with contextlib.redirect_stdout(std):
-                model = load_model(model_name, base_kernel_width=11)
-        with contextlib.redirect_stdout(std):
-            model.eval()
-            model, use_cuda, num_devices = set_device(model, -2)
-
-        for path in progress.track(inputs, description="Denoising..."):
-            subtask = progress.add_task(description=path.name)
-            _run_and_update_progress(
-                progress,
-                subtask,
-                denoise,
-                model=model,
-                path=path,
-                outdir=str(outdir),
-                batch_size=num_devices,
-                patch_size=patch_size,
-                padding=patch_size // 2,
-                suffix="",
+            device = -2 if gpus is None else next(iter(gpus))
+            start = time.time()
+            try:
+                model = _train_model(
+                    even=str(even),
+                    odd=str(odd),
+                    save_prefix=str(outdir / "trained_models" / model_name),
+                    device=device,
+                    tile_size=tile_size,
+                    update=partial(progress.update, task),
+                    num_workers=multiprocessing.cpu_count(),
+                    max_memory=train_memory,
+                )
+            except RuntimeError as e:
+                if _is_out_of_memory(e):
+                    raise RuntimeError(OUT_OF_MEMORY) from e
+                raise
+            # save the weights so the denoising workers can load them
+            model_name = str(outdir / "trained_models" / f"{model_name}.sav")
+            torch.save(model.state_dict(), model_name)
+            # the workers need the training gpu's memory more than we do
+            del model
+            torch.cuda.empty_cache()
+            if tracer is not None:
+                tracer.record(
+                    "model",
+                    "Training",
+                    start,
+                    start,
+                    time.time(),
+                    resource="GPUs" if device == -2 else f"GPU {device}",
+                    outputs=[model_name],
+                )
+
+        # one worker process (and model copy) per device; tomograms are picked
+        # from a shared queue by whichever worker is free, so slower devices
+        # end up with fewer of them
+        devices = _get_devices(gpus, n_inputs=len(inputs))[: len(inputs)]
+        log.info(f"denoising with {len(devices)} workers on devices: {devices}")
+        ctx = multiprocessing.get_context("spawn")  # needed for cuda
+        todo = ctx.Queue()
+        results = ctx.Queue()
+        queued = time.time()
+        for path in inputs:
+            todo.put(path)
+        for _ in devices:
+            todo.put(None)
+        workers = [
+            ctx.Process(
+                target=_denoise_worker,
+                args=(
+                    model_name,
+                    device,
+                    num_threads,
+                    outdir,
+                    patch_size,
+                    queue_depth,
+                    output_format,
+                    todo,
+                    results,
+                ),
+                daemon=True,
             )
-            progress.update(subtask, visible=False)
+            for device, num_threads in devices
+        ]
+
+        task = progress.add_task(description="Denoising...", total=len(inputs))
+        failed = {}
+        try:
+            for worker in workers:
+                worker.start()
+            # fraction of each tomogram being denoised right now
+            in_flight = {}
+            remaining = set(inputs)
+            while remaining:
+                try:
+                    path, kind, value = results.get(timeout=1)
+                except Empty:
+                    if not any(worker.is_alive() for worker in workers):
+                        log.error("Denoising: all workers died")
+                        failed.update(dict.fromkeys(remaining, "worker died"))
+                        break
+                    continue
+                if kind == "error" and path is None:
+                    # a worker could not start, the others take over its share
+                    log.error(f"Denoising: {value}")
+                    continue
+                if kind == "progress":
+                    in_flight[path] = value
+                elif kind == "error":
+                    # only this tomogram is lost, the others carry on
+                    in_flight.pop(path, None)
+                    remaining.discard(path)
+                    log.error(f"Denoising: {path.name} failed: {value}")
+                    failed[path] = value
+                else:
+                    in_flight.pop(path, None)
+                    remaining.discard(path)
+                    write_manifest(outputs[path], descriptions[path])
+                    if tracer is not None:
+                        start, end, device = value
+                        tracer.record(
+                            path.name,
+                            "Denoising",
+                            queued,
+                            start,
+                            end,
+                            resource="CPU" if device == -1 else f"GPU {device}",
+                            inputs=[path],
+                            outputs=[outputs[path]],
+                        )
+                done = len(inputs) - len(remaining)
+                progress.update(task, completed=done + sum(in_flight.values()))
+            for worker in workers:
+                worker.join()
+        finally:
+            for worker in workers:
+                if worker.is_alive():
+                    worker.terminate()
+        if failed:
+            log.error(f"Denoising: {len(failed)} of {len(inputs)} tomograms failed")
+        return list(failed)
+    return []
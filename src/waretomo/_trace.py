@@ -0,0 +1,113 @@
+import json
+import threading
+import time
+from pathlib import Path
+
+
+def _size(paths):
+    total = 0
+    for path in map(Path, paths):
+        if path.is_dir():
+            # e.g. zarr
+            total += sum(f.stat().st_size for f in path.rglob("*") if f.is_file())
+        elif path.is_file():
+            total += path.stat().st_size
+    return total
+
+
+class Tracer:
+    """
+    Collect timing information about each job of a run.
+
+    Each record covers one attempt at running a job, on a given resource (e.g.
+    "GPU 0" or "CPU"). Times are wall-clock seconds, so records coming from other
+    processes can be mixed in. Bytes read and written are the sizes of the
+    job's input and output files.
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.records = []
+        self._lock = threading.Lock()
+
+    def record(
+        self,
+        name,
+        label,
+        queued,
+        start,
+        end,
+        resource="CPU",
+        status="done",
+        inputs=(),
+        outputs=(),
+    ):
+        record = {
+            "name": name,
+            "label": label,
+            "resource": resource,
+            "status": status,
+            "queued": queued,
+            "start": start,
+            "end": end,
+            "queue_wait": start - queued,
+            "duration": end - start,
+            "bytes_read": _size(inputs),
+            "bytes_written": _size(outputs) if status == "done" else 0,
+        }
+        with self._lock:
+            self.records.append(record)
+
+    def _chrome_events(self):
+        """Events in the chrome trace format, one row per concurrent job."""
+        resources = sorted({r["resource"] for r in self.records})
+        events = []
+        for pid, resource in enumerate(resources):
+            events.append(
+                {
+                    "ph": "M",
+                    "name": "process_name",
+                    "pid": pid,
+                    "args": {"name": resource},
+                }
+            )
+            # pack jobs into as few rows as possible, like slots on a gpu
+            lanes = []
+            records = [r for r in self.records if r["resource"] == resource]
+            for r in sorted(records, key=lambda r: r["start"]):
+                free = [
+                    i for i, busy_until in enumerate(lanes) if busy_until <= r["start"]
+                ]
+                if free:
+                    tid = free[0]
+                else:
+                    tid = len(lanes)
+                    lanes.append(0)
+                lanes[tid] = r["end"]
+                events.append(
+                    {
+                        "ph": "X",
+                        "name": f"{r['label']}: {r['name']}",
+                        "cat": r["status"],
+                        "pid": pid,
+                        "tid": tid,
+                        "ts": (r["start"] - self.start) * 1e6,
+                        "dur": r["duration"] * 1e6,
+                        "args": r,
+                    }
+                )
+        return events
+
+    def save(self, output_dir, name="waretomo_trace"):
+        """
+        Write the records as json lines and as a chrome trace.
+
+        The trace can be opened in https://ui.perfetto.dev or chrome://tracing.
+        """
+        with self._lock:
+            records = sorted(self.records, key=lambda r: r["start"])
+        with open(output_dir / f"{name}.jsonl", "w") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+        with open(output_dir / f"{name}.json", "w") as f:
+            json.dump({"traceEvents": self._chrome_events()}, f)
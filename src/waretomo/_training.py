@@ -0,0 +1,173 @@
+import logging
+import random
+from collections import OrderedDict
+from pathlib import Path
+
+import mrcfile
+import numpy as np
+import torch
+
+# fraction of each tomogram (along x) kept aside for validation
+TEST_FRACTION = 0.1
+# number of z slices read at once when computing statistics
+STATS_CHUNK = 16
+
+
+def _find_pairs(even, odd):
+    even, odd = Path(even), Path(odd)
+    if even.is_file() and odd.is_file():
+        return [(even, odd)]
+    pairs = []
+    for even_path in sorted(even.glob("*.mrc")):
+        odd_path = odd / even_path.name
+        if odd_path.is_file():
+            pairs.append((even_path, odd_path))
+        else:
+            logging.getLogger("waretomo").warning(
+                f"{even_path} has no odd counterpart, not using it for training."
+            )
+    return pairs
+
+
+def _mean_std(data):
+    """Mean and std of a (memory-mapped) volume, reading a few slices at a time."""
+    total = 0.0
+    total_sq = 0.0
+    for start in range(0, data.shape[0], STATS_CHUNK):
+        chunk = data[start : start + STATS_CHUNK].astype(np.float64)
+        total += chunk.sum()
+        total_sq += np.square(chunk).sum()
+    mean = total / data.size
+    return mean, np.sqrt(max(total_sq / data.size - mean**2, 0))
+
+
+class HalfTomogramPatches(torch.utils.data.Dataset):
+    """
+    Training pairs of tiles sampled from even/odd half tomograms.
+
+    A drop-in replacement for topaz's TrainingDataset3D, which instead keeps
+    every tomogram in memory in each dataloader worker. Here half tomograms are
+    memory-mapped, so their pages are read lazily and shared between workers
+    through the page cache. Each process keeps at most `max_mapped` bytes of
+    tomograms mapped at a time (unlimited if None), closing the least recently
+    used ones first.
+
+    Tiles are sampled at random positions; the last part of each tomogram along
+    x is only used for validation, so train and test tiles never overlap.
+    """
+
+    def __init__(self, even, odd, tile_size, n_train, n_test, max_mapped=None):
+        log = logging.getLogger("waretomo")
+        self.tile_size = tile_size
+        self.n_train = n_train
+        self.n_test = n_test
+        self.max_mapped = max_mapped
+        self.mode = "train"
+
+        self.pairs = []
+        self.sizes = []
+        self.stats = []
+        self.coords = {"train": [], "test": []}
+        rng = np.random.default_rng()
+        t = tile_size
+        for even_path, odd_path in _find_pairs(even, odd):
+            with mrcfile.mmap(even_path, mode="r", permissive=True) as e:
+                with mrcfile.mmap(odd_path, mode="r", permissive=True) as o:
+                    if e.data.shape != o.data.shape:
+                        log.warning(
+                            f"shape mismatch between {even_path} and {odd_path}, "
+                            "not using them for training."
+                        )
+                        continue
+                    nz, ny, nx = e.data.shape
+                    test_width = max(t, round(nx * TEST_FRACTION))
+                    if min(nz, ny) < t or nx - test_width < t:
+                        log.warning(
+                            f"{even_path} is too small for tiles of size {t}, "
+                            "not using it for training."
+                        )
+                        continue
+                    stats = (_mean_std(e.data), _mean_std(o.data))
+                    size = e.data.nbytes + o.data.nbytes
+            self.pairs.append((even_path, odd_path))
+            self.stats.append(stats)
+            self.sizes.append(size)
+            # lower corner of each tile
+            for mode, n, (x_min, x_max) in (
+                ("train", n_train, (0, nx - test_width - t)),
+                ("test", n_test, (nx - test_width, nx - t)),
+            ):
+                self.coords[mode].append(
+                    np.stack(
+                        [
+                            rng.integers(0, nz - t, n, endpoint=True),
+                            rng.integers(0, ny - t, n, endpoint=True),
+                            rng.integers(x_min, x_max, n, endpoint=True),
+                        ],
+                        axis=1,
+                    )
+                )
+
+        if not self.pairs:
+            raise RuntimeError(f"no usable half tomograms found in {even} and {odd}")
+
+        # per-process map cache, filled lazily so each worker opens its own maps
+        self._maps = OrderedDict()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_maps"] = OrderedDict()
+        return state
+
+    def _open(self, idx):
+        if idx in self._maps:
+            self._maps.move_to_end(idx)
+            return self._maps[idx]
+        if self.max_mapped is not None:
+            mapped = sum(self.sizes[i] for i in self._maps)
+            while self._maps and mapped + self.sizes[idx] > self.max_mapped:
+                old, maps = self._maps.popitem(last=False)
+                for m in maps:
+                    m.close()
+                mapped -= self.sizes[old]
+        self._maps[idx] = tuple(
+            mrcfile.mmap(path, mode="r", permissive=True) for path in self.pairs[idx]
+        )
+        return self._maps[idx]
+
+    def set_mode(self, mode):
+        assert mode in ("train", "test")
+        self.mode = mode
+
+    def __len__(self):
+        n = self.n_train if self.mode == "train" else self.n_test
+        return n * len(self.pairs)
+
+    def __getitem__(self, idx):
+        n = self.n_train if self.mode == "train" else self.n_test
+        # consecutive indices come from the same tomogram, to keep maps warm
+        tomo, idx = divmod(idx, n)
+        z, y, x = self.coords[self.mode][tomo][idx]
+        t = self.tile_size
+        tiles = []
+        for m, (mean, std) in zip(self._open(tomo), self.stats[tomo]):
+            tile = np.array(m.data[z : z + t, y : y + t, x : x + t], dtype=np.float32)
+            tiles.append((tile - mean) / std)
+        source, target = self._augment(*tiles)
+        return (
+            torch.from_numpy(source).float().unsqueeze(0),
+            torch.from_numpy(target).float().unsqueeze(0),
+        )
+
+    @staticmethod
+    def _augment(x, y):
+        # same as topaz: random mirroring and 90 degree rotations
+        for ax in range(3):
+            if random.random() < 0.5:
+                x = np.flip(x, axis=ax)
+                y = np.flip(y, axis=ax)
+        for axes in ((0, 1), (0, 2), (1, 2)):
+            k = random.randrange(4)
+            x = np.rot90(x, k=k, axes=axes)
+            y = np.rot90(y, k=k, axes=axes)
+        return np.ascontiguousarray(x), np.ascontiguousarray(y)
@@ -0,0 +1,150 @@
+import ctypes
+import logging
+import os
+import select
+import time
+
+# rescan even without events: inotify does not see changes made by other nfs/smb
+# clients, such as a windows machine running warp
+POLL_INTERVAL = 30
+# minimum time between rescans, so a burst of events causes a single rescan
+MIN_INTERVAL = 5
+# stacks modified more recently than this may still be being written by warp
+SETTLE_TIME = 60
+
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+
+class DirWatcher:
+    """
+    Wait for changes in a set of directories.
+
+    Uses inotify if available, and falls back to polling every `interval` seconds.
+    Directories are not watched recursively, but `subdirs_of` are rescanned for new
+    subdirectories on every call to `wait`.
+    """
+
+    def __init__(self, dirs, subdirs_of=(), interval=POLL_INTERVAL):
+        self.dirs = [str(d) for d in dirs]
+        self.subdirs_of = [str(d) for d in subdirs_of]
+        self.interval = interval
+        self.last = time.monotonic()
+        self.fd = None
+        try:
+            self.libc = ctypes.CDLL(None, use_errno=True)
+            fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except (OSError, AttributeError, TypeError):
+            fd = -1
+        if fd < 0:
+            logging.getLogger("waretomo").info(
+                f"inotify is not available, polling every {interval} seconds."
+            )
+        else:
+            self.fd = fd
+
+    def _add_watches(self):
+        dirs = list(self.dirs)
+        for parent in self.subdirs_of:
+            if os.path.isdir(parent):
+                dirs += [e.path for e in os.scandir(parent) if e.is_dir()]
+        mask = IN_CREATE | IN_CLOSE_WRITE | IN_MOVED_TO | IN_MODIFY
+        for d in dirs:
+            # adding a watch twice is a no-op; errors mean the dir doesn't exist yet
+            self.libc.inotify_add_watch(self.fd, os.fsencode(d), mask)
+
+    def _drain(self):
+        try:
+            while os.read(self.fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+
+    def wait(self):
+        """Block until something changed in the directories, or a timeout passes."""
+        if self.fd is None:
+            time.sleep(max(self.interval - (time.monotonic() - self.last), 0))
+        else:
+            self._add_watches()
+            timeout = max(self.interval - (time.monotonic() - self.last), 0)
+            select.select([self.fd], [], [], timeout)
+            time.sleep(max(MIN_INTERVAL - (time.monotonic() - self.last), 0))
+            self._drain()
+        self.last = time.monotonic()
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def watch_data(
+    warp_dir, mdoc_dir, seen=(), interval=POLL_INTERVAL, settle=SETTLE_TIME, **kwargs
+):
+    """
+    Yield lists of new tilt series as soon as they are ready to be processed.
+
+    Runs forever: mdocs, imod stacks and xmls are rescanned whenever they change.
+    Tilt series whose name is in `seen` are skipped. Additional kwargs are passed
+    to parse_data.
+
+    Only the mdocs of tilt series which were not yielded yet are parsed again,
+    and the extracted data is kept in memory between rescans. Tilt series which
+    cannot be parsed yet (e.g. their mdoc is still being written) are retried on
+    the next rescan.
+    """
+    from rich.progress import Progress
+
+    from ._cache import ParseCache
+    from ._parse import parse_data
+
+    log = logging.getLogger("waretomo")
+    seen = set(seen)
+    # mdocs of tilt series which don't need to be parsed again
+    done = set()
+    cache = ParseCache(kwargs.pop("cache_file", None))
+    just = kwargs.pop("just", ())
+    imod_dir = warp_dir / "imod"
+    watcher = DirWatcher(
+        [warp_dir, mdoc_dir, imod_dir], subdirs_of=[imod_dir], interval=interval
+    )
+    try:
+        while True:
+            tilt_series = []
+            if just:
+                mdocs = [mdoc_dir / (ts_name + ".mdoc") for ts_name in just]
+            else:
+                mdocs = sorted(mdoc_dir.glob("*.mdoc"))
+            mdocs = [mdoc for mdoc in mdocs if mdoc not in done and mdoc.exists()]
+            # data collection may not even have started yet
+            if imod_dir.exists() and mdocs:
+                with Progress(disable=True) as quiet:
+                    tilt_series, _, _ = parse_data(
+                        quiet,
+                        warp_dir,
+                        mdoc_dir,
+                        cache=cache,
+                        mdocs=mdocs,
+                        skip_errors=True,
+                        **kwargs,
+                    )
+            done.update(ts["mdoc"] for ts in tilt_series if ts["name"] in seen)
+            now = time.time()
+            new = [
+                ts
+                for ts in tilt_series
+                if ts["name"] not in seen and now - ts["stack"].stat().st_mtime > settle
+            ]
+            if new:
+                seen.update(ts["name"] for ts in new)
+                done.update(ts["mdoc"] for ts in new)
+                log.info(f"New tilt series: {', '.join(ts['name'] for ts in new)}.")
+                yield new
+            else:
+                watcher.wait()
+    finally:
+        watcher.close()
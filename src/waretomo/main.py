@@ -10,6 +10,7 @@ class ProcessingStep(str, Enum):
 
     align = auto()
     tilt_mdocs = auto()
+    preview = auto()
     reconstruct = auto()
     stack_halves = auto()
     reconstruct_halves = auto()
@@ -109,7 +110,38 @@ class ProcessingStep(str, Enum):
     "Extension does not matter, but names should be same as TS.",
 )
 @click.option(
-    "-f", "--overwrite", is_flag=True, help="overwrite any previous existing run"
+    "-f",
+    "--overwrite",
+    is_flag=True,
+    help="overwrite any previous existing run, even if outputs are up to date",
+)
+@click.option(
+    "--resume",
+    is_flag=True,
+    help="remove the outputs of jobs which were interrupted in a previous run (e.g. "
+    "by a crash), since they may be incomplete. Otherwise, they are only marked "
+    "as incomplete, and remade when their step runs again. Other workers sharing "
+    "a --queue should not be running.",
+)
+@click.option(
+    "--preview",
+    is_flag=True,
+    help="before full reconstruction, make a quick low resolution preview of every "
+    "tilt series in OUTPUT_DIR/preview (volume and png of its central slab). "
+    "Full processing then skips tilt series whose preview failed or which are "
+    "listed in OUTPUT_DIR/preview/rejected.txt (one name per line). Add "
+    "`--stop-at preview` to only make the previews and triage them first.",
+)
+@click.option(
+    "--preview-binning",
+    type=int,
+    default=16,
+    help="binning of the previews (same reference as --binning).",
+)
+@click.option(
+    "--preview-thickness",
+    type=int,
+    help="unbinned thickness of the previews [default: --sample-thickness]",
 )
 @click.option(
     "--train", is_flag=True, default=False, help="whether to train a new denosing model"
@@ -120,12 +152,35 @@ class ProcessingStep(str, Enum):
     default=64,
     help="tile size for training topaz model.",
 )
+@click.option(
+    "--topaz-train-memory",
+    type=int,
+    help="maximum amount of half tomograms (in MB) mapped in memory at once "
+    "while training topaz. Default: no limit (pages are still read lazily and "
+    "can be reclaimed by the system).",
+)
 @click.option(
     "--topaz-patch-size",
     type=int,
     default=64,
     help="patch size for denoising in topaz.",
 )
+@click.option(
+    "--topaz-queue-depth",
+    type=int,
+    default=1,
+    help="number of tomograms per denoising worker to read ahead and to "
+    "queue for writing while the device is busy. Higher values hide slow "
+    "storage better, at the cost of host memory.",
+)
+@click.option(
+    "--topaz-format",
+    type=click.Choice(["mrc", "mrc-float16", "ome-zarr"]),
+    default="mrc",
+    help="format of the denoised tomograms: float32 mrc, float16 mrc (mode 12, "
+    "half the size) or OME-Zarr (compressed, chunked and multiscale, so viewers "
+    "can open it lazily; needs `pip install waretomo[zarr]`).",
+)
 @click.option(
     "--topaz-model",
     type=str,
@@ -149,11 +204,70 @@ class ProcessingStep(str, Enum):
     help="terminate processing after this step",
 )
 @click.option("--aretomo", type=str, default="AreTomo", help="aretomo executable")
+@click.option(
+    "--newstack",
+    type=str,
+    help="use this newstack executable to stack halves, instead of the built-in "
+    "stack writer",
+)
 @click.option(
     "--gpus",
     type=str,
     help="Comma separated list of gpus to use for aretomo. Default to all.",
 )
+@click.option(
+    "--gpu-slots",
+    type=int,
+    default=1,
+    help="maximum number of AreTomo jobs to run at the same time on each gpu. "
+    "If 0, pack as many jobs as fit in the free memory of each gpu.",
+)
+@click.option(
+    "--timeout",
+    type=float,
+    help="kill AreTomo jobs running for longer than this many minutes",
+)
+@click.option(
+    "--retries",
+    type=int,
+    default=1,
+    help="number of times a failed AreTomo job is retried (on a different gpu, "
+    "if possible). GPUs that keep failing are excluded from the run.",
+)
+@click.option(
+    "--scratch",
+    type=click.Path(file_okay=False, resolve_path=True),
+    help="node-local directory (e.g. an SSD or tmpfs) where AreTomo inputs are "
+    "copied before each job; results are copied back to OUTPUT_DIR afterwards.",
+)
+@click.option(
+    "--scratch-size",
+    type=float,
+    help="maximum space (in GB) to use in the scratch directory. "
+    "Default: most of its free space.",
+)
+@click.option(
+    "--runtime-history",
+    type=click.Path(dir_okay=False, resolve_path=True),
+    help="file where the runtime of each AreTomo job is recorded, to start the "
+    "longest jobs first and predict runtimes in --dry-run "
+    "[default: ~/.cache/waretomo/runtimes.jsonl]",
+)
+@click.option(
+    "--watch",
+    is_flag=True,
+    help="keep running, and process new tilt series as soon as Warp is done with "
+    "them (e.g. during data collection). Stop with Ctrl+C. With --train, "
+    "denoising is skipped and should be run at the end with `--start-from denoise`.",
+)
+@click.option(
+    "--queue",
+    type=str,
+    help="name of a work queue shared by several waretomo processes (on one or "
+    "more nodes) started with the same OUTPUT_DIR. Each job is run by only one "
+    "of them; jobs of workers that died are taken over by the others. "
+    "Use a new name for each session.",
+)
 @click.option(
     "--tiltcorr/--no-tiltcorr", default=True, help="do not correct sample tilt"
 )
@@ -174,14 +288,30 @@ def cli(
     patches,
     roi_dir,
     overwrite,
+    resume,
+    preview,
+    preview_binning,
+    preview_thickness,
     train,
     topaz_tile_size,
+    topaz_train_memory,
     topaz_patch_size,
+    topaz_queue_depth,
+    topaz_format,
     topaz_model,
     start_from,
     stop_at,
     aretomo,
+    newstack,
     gpus,
+    gpu_slots,
+    timeout,
+    retries,
+    scratch,
+    scratch_size,
+    runtime_history,
+    watch,
+    queue,
     tiltcorr,
 ):
     """
@@ -247,18 +377,40 @@ def cli(
                 f"or one of {pretrained_models}."
             )
 
+    from ._preview import read_rejected
+
+    # previews may have been triaged in a previous run
+    if rejected := read_rejected(output_dir / "preview"):
+        log.info(f"Excluding tilt series rejected after preview: {rejected}")
+
+    parse_kwargs = {
+        "output_dir": output_dir,
+        "roi_dir": roi_dir,
+        "just": just,
+        "exclude": (*exclude, *rejected),
+        "train": train,
+        "dose": dose,
+        "cache_file": output_dir / "waretomo_cache.json",
+    }
+
+    if topaz_format == "ome-zarr":
+        try:
+            import zarr  # noqa: F401
+        except ImportError:
+            raise click.UsageError(
+                "--topaz-format ome-zarr needs zarr: pip install waretomo[zarr]"
+            ) from None
+
     with Progress() as progress:
-        tilt_series, tilt_series_excluded, tilt_series_unprocessed = parse_data(
-            progress,
-            warp_dir,
-            mdoc_dir=mdoc_dir,
-            output_dir=output_dir,
-            roi_dir=roi_dir,
-            just=just,
-            exclude=exclude,
-            train=train,
-            dose=dose,
-        )
+        try:
+            tilt_series, tilt_series_excluded, tilt_series_unprocessed = parse_data(
+                progress, warp_dir, mdoc_dir=mdoc_dir, **parse_kwargs
+            )
+        except FileNotFoundError:
+            # in watch mode, data collection may not have started yet
+            if not watch:
+                raise
+            tilt_series, tilt_series_excluded, tilt_series_unprocessed = [], [], []
 
         aretomo_kwargs = {
             "cmd": aretomo,
@@ -268,6 +420,9 @@ def cli(
             "thickness_recon": z_thickness,
             "binning": binning,
             "gpus": gpus,
+            "gpu_slots": gpu_slots,
+            "timeout": timeout * 60 if timeout is not None else None,
+            "retries": retries,
             "tilt_corr": tiltcorr,
         }
 
@@ -281,7 +436,10 @@ def cli(
             "model_name": topaz_model,
             "gpus": gpus,
             "tile_size": topaz_tile_size,
+            "train_memory": topaz_train_memory,
             "patch_size": topaz_patch_size,
+            "queue_depth": topaz_queue_depth,
+            "output_format": topaz_format,
         }
 
         start_from = ProcessingStep[start_from]
@@ -291,9 +449,13 @@ def cli(
             step: start_from <= val <= stop_at
             for step, val in ProcessingStep.__members__.items()
         }
+        steps["preview"] = steps["preview"] and preview
         if not train:
             steps["stack_halves"] = False
             steps["reconstruct_halves"] = False
+        elif watch:
+            # the model should be trained on the whole dataset
+            steps["denoise"] = False
 
         nl = "\n"
 
@@ -330,24 +492,27 @@ def cli(
         )
         print(Panel(summary))
 
-        ts = tilt_series[0]
-        ts_name = ts["name"]
-        ts_info = {k: v for k, v in ts.items() if k not in ("even", "odd")}
-        ts_info = {
-            k: (str(v.relative_to(warp_dir)) if isinstance(v, Path) else v)
-            for k, v in ts_info.items()
-            if k
-        }
-        ts_info.update(ts_info.pop("aretomo_kwargs"))
-        ts_info = "".join(f'{nl}{" " * 12}- {k}: {v}' for k, v in ts_info.items())
-        first_ts_summary = cleandoc(
-            f"""
-            Double check that these values make sense for {ts_name}:
-            {ts_info}
-            """
-        )
+        if tilt_series:
+            ts = tilt_series[0]
+            ts_name = ts["name"]
+            ts_info = {
+                k: v for k, v in ts.items() if k not in ("even", "odd", "tilt_angles")
+            }
+            ts_info = {
+                k: (str(v.relative_to(warp_dir)) if isinstance(v, Path) else v)
+                for k, v in ts_info.items()
+                if k
+            }
+            ts_info.update(ts_info.pop("aretomo_kwargs"))
+            ts_info = "".join(f'{nl}{" " * 12}- {k}: {v}' for k, v in ts_info.items())
+            first_ts_summary = cleandoc(
+                f"""
+                Double check that these values make sense for {ts_name}:
+                {ts_info}
+                """
+            )
 
-        print(Panel(first_ts_summary))
+            print(Panel(first_ts_summary))
 
         if not dry_run:
             with open(output_dir / "waretomo.log", "a") as f:
@@ -356,86 +521,165 @@ def cli(
                 print(f'Command: {" ".join(sys.argv)}', file=f)
                 print(summary, "\n", file=f)
 
-        if steps["align"]:
-            from ._aretomo import aretomo_batch
-
-            log.info("Aligning with AreTomo...")
-            aretomo_batch(
-                progress,
-                tilt_series,
-                label="Aligning",
-                **aretomo_kwargs,
-                **meta_kwargs,
+        if steps["tilt_mdocs"] and not tiltcorr:
+            log.info("No need to tilt mdocs!")
+
+        from ._journal import Journal
+        from ._runtime import RuntimeHistory, default_history_file
+        from ._trace import Tracer
+
+        # timing of each job, to find idle gpus and stragglers after the fact
+        tracer = Tracer()
+        history = RuntimeHistory(runtime_history or default_history_file())
+        trace_name = "waretomo_trace"
+        work_queue = None
+        if queue is not None and not dry_run:
+            import os
+            import socket
+
+            from ._queue import WorkQueue
+
+            work_queue = WorkQueue(output_dir / ".waretomo_queue" / queue)
+            trace_name += f"_{socket.gethostname()}_{os.getpid()}"
+        journal = Journal(output_dir / "waretomo_journal.jsonl")
+        # jobs running on other workers of the queue are left alone
+        if resume and not dry_run:
+            if redone := journal.resume(work_queue):
+                log.warning(f"Redoing {len(redone)} interrupted jobs.")
+        elif interrupted := (
+            journal.interrupted() if dry_run else journal.invalidate(work_queue)
+        ):
+            print(
+                f"[bold yellow]Warning[/bold yellow]: {len(interrupted)} jobs were "
+                "interrupted in a previous run; their outputs are incomplete, and "
+                "will be remade. Use --resume to remove them right away."
             )
+        if dry_run:
+            journal = None
 
-        if steps["tilt_mdocs"]:
-            if not tiltcorr:
-                log.info("No need to tilt mdocs!")
-            else:
-                from ._fix_mdoc import tilt_mdocs_batch
-
-                log.info("Tilting mdocs...")
-                (mdoc_dir / "mdoc_tilted").mkdir(parents=True, exist_ok=True)
-                tilt_mdocs_batch(
-                    progress,
-                    tilt_series,
-                    **meta_kwargs,
-                )
+        pipeline_kwargs = {
+            "output_dir": output_dir,
+            "gpus": gpus,
+            "gpu_slots": gpu_slots,
+            "aretomo_kwargs": aretomo_kwargs,
+            "tilt_corr": tiltcorr,
+            "newstack": newstack,
+            "preview_binning": preview_binning,
+            "preview_thickness": preview_thickness,
+            "history": history,
+            **meta_kwargs,
+        }
 
-        if steps["reconstruct"]:
-            from ._aretomo import aretomo_batch
+        def run_aretomo(tilt_series, steps):
+            if not any(v for k, v in steps.items() if k != "denoise"):
+                return {}
+            from ._pipeline import run_pipeline
 
-            log.info("Reconstructing with AreTomo...")
-            aretomo_batch(
+            log.info("Processing tilt series with AreTomo...")
+            return run_pipeline(
                 progress,
                 tilt_series,
-                reconstruct=True,
-                label="Reconstructing",
-                **aretomo_kwargs,
-                **meta_kwargs,
+                steps=steps,
+                retries=retries,
+                scratch=scratch,
+                scratch_size=scratch_size and scratch_size * 2**30,
+                tracer=tracer,
+                queue=work_queue,
+                journal=journal,
+                **pipeline_kwargs,
             )
 
-        if steps["stack_halves"]:
-            from ._stack import prepare_half_stacks
-
-            for half in ("even", "odd"):
-                log.info(f"Preparing {half} stacks for denoising...")
-                prepare_half_stacks(progress, tilt_series, half=half, **meta_kwargs)
+        # preview everything before spending gpu hours on full processing
+        up_to_preview = {
+            k: v and ProcessingStep[k] <= ProcessingStep.preview
+            for k, v in steps.items()
+        }
+        after_preview = {k: v and not up_to_preview[k] for k, v in steps.items()}
 
-        if steps["reconstruct_halves"]:
-            from ._aretomo import aretomo_batch
+        def process(tilt_series, denoise_key="denoise"):
+            if dry_run:
+                from ._pipeline import print_prediction
 
-            for half in ("even", "odd"):
-                log.info(f"Reconstructing {half} tomograms for deonoising...")
-                half_dir = output_dir / half
-                half_dir.mkdir(parents=True, exist_ok=True)
-                aretomo_batch(
+                print_prediction(
                     progress,
                     tilt_series,
-                    suffix=f"_{half}",
-                    reconstruct=True,
-                    label=f"Reconstructing {half} halves",
-                    **aretomo_kwargs,
+                    [up_to_preview, after_preview] if steps["preview"] else [steps],
+                    **pipeline_kwargs,
+                )
+            if steps["preview"]:
+                state = run_aretomo(tilt_series, up_to_preview)
+                # only failures which make previews useless: e.g. a tilted mdoc
+                # which could not be written is no reason to give up on a series
+                failed = {
+                    job.name
+                    for job, s in state.items()
+                    if s == "failed" and job.label in ("Aligning", "Previewing")
+                }
+                rejected = set(read_rejected(output_dir / "preview"))
+                skipped = [
+                    ts["name"]
+                    for ts in tilt_series
+                    if ts["name"] in failed or ts["name"] in rejected
+                ]
+                if skipped:
+                    log.warning(
+                        f"Skipping {len(skipped)} tilt series after preview: "
+                        f"{', '.join(skipped)}"
+                    )
+                tilt_series = [ts for ts in tilt_series if ts["name"] not in skipped]
+                run_aretomo(tilt_series, after_preview)
+            else:
+                run_aretomo(tilt_series, steps)
+
+            # denoising is a single job, because of training
+            if steps["denoise"] and (
+                work_queue is not None and work_queue.claim(denoise_key) is None
+            ):
+                log.warning("Denoising is done by another worker.")
+            elif steps["denoise"]:
+                from ._topaz import topaz_batch
+
+                log.info("Denoising tomograms...")
+                outdir_denoised = output_dir / "denoised"
+                outdir_denoised.mkdir(parents=True, exist_ok=True)
+                not_denoised = topaz_batch(
+                    progress,
+                    tilt_series,
+                    outdir=outdir_denoised,
+                    even=str(output_dir / "even"),
+                    odd=str(output_dir / "odd"),
+                    **topaz_kwargs,
+                    tracer=tracer,
                     **meta_kwargs,
                 )
-                # remove leftovers from aretomo otherwise topaz dies later
-                for f in half_dir.glob("*_projX?.mrc"):
-                    f.unlink(missing_ok=True)
-                for f in half_dir.glob("*.aretomolog"):
-                    f.unlink(missing_ok=True)
-
-        if steps["denoise"]:
-            from ._topaz import topaz_batch
-
-            log.info("Denoising tomograms...")
-            outdir_denoised = output_dir / "denoised"
-            outdir_denoised.mkdir(parents=True, exist_ok=True)
-            topaz_batch(
-                progress,
-                tilt_series,
-                outdir=outdir_denoised,
-                even=str(output_dir / "even"),
-                odd=str(output_dir / "odd"),
-                **topaz_kwargs,
-                **meta_kwargs,
-            )
+                if work_queue is not None:
+                    work_queue.finish(
+                        denoise_key, status="failed" if not_denoised else "done"
+                    )
+
+        try:
+            if tilt_series:
+                process(tilt_series)
+            if watch:
+                from ._watch import watch_data
+
+                log.warning("Watching for new tilt series, press Ctrl+C to stop.")
+                try:
+                    for new in watch_data(
+                        warp_dir,
+                        mdoc_dir,
+                        seen=[ts["name"] for ts in tilt_series],
+                        **parse_kwargs,
+                    ):
+                        # don't pile up progress bars over a whole session
+                        for task in progress.tasks:
+                            if task.finished:
+                                progress.remove_task(task.id)
+                        process(new, denoise_key=f"denoise-{new[0]['name']}")
+                except KeyboardInterrupt:
+                    log.warning("Stopped watching.")
+        finally:
+            if work_queue is not None:
+                work_queue.close()
+            if not dry_run:
+                tracer.save(output_dir, name=trace_name)
@@ -0,0 +1,125 @@
+"""
+Time the orchestration overhead of waretomo on synthetic data.
+
+Runs the main processing steps with fake executables (see synthetic.py), so
+only the time spent by waretomo itself (parsing, scheduling, io) is measured:
+
+    python tests/benchmark.py --sizes 10 100 1000
+"""
+
+import argparse
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from rich.progress import Progress
+from synthetic import make_fake_tools, make_warp_tree
+
+SIZES = (10, 100, 1000)
+# fake gpus: the fake aretomo ignores them, so this only sets the parallelism
+GPUS = (0, 1, 2, 3)
+
+
+@contextmanager
+def _timed(timings, name):
+    start = time.perf_counter()
+    yield
+    timings[name] = time.perf_counter() - start
+
+
+def run_benchmark(root, n_tilt_series, n_tilts=41, aretomo_runtime=0.0):
+    """
+    Generate a dataset in root and time each processing step on it.
+
+    Returns a dict of step name: seconds.
+    """
+    from waretomo._aretomo import aretomo_batch
+    from waretomo._fix_mdoc import tilt_mdocs_batch
+    from waretomo._parse import parse_data
+    from waretomo._stack import prepare_half_stacks
+
+    root = Path(root)
+    warp_dir = make_warp_tree(root / "warp", n_tilt_series, n_tilts)
+    output_dir = root / "output"
+    output_dir.mkdir()
+    aretomo, newstack = make_fake_tools(root / "bin", aretomo_runtime)
+    aretomo_kwargs = {
+        "cmd": str(aretomo),
+        "gpus": GPUS,
+        "binning": 4,
+        "thickness_align": 400,
+        "thickness_recon": 1200,
+    }
+
+    timings = {}
+    with Progress(disable=True) as progress:
+        for name in ("parse_data", "parse_data (cached)"):
+            with _timed(timings, name):
+                tilt_series, _, _ = parse_data(
+                    progress,
+                    warp_dir,
+                    mdoc_dir=warp_dir,
+                    output_dir=output_dir,
+                    roi_dir=None,
+                    train=True,
+                    cache_file=output_dir / "waretomo_cache.json",
+                )
+        assert len(tilt_series) == n_tilt_series
+
+        with _timed(timings, "aretomo_batch (align)"):
+            aretomo_batch(progress, tilt_series, label="Aligning", **aretomo_kwargs)
+
+        (warp_dir / "mdoc_tilted").mkdir()
+        with _timed(timings, "tilt_mdocs_batch"):
+            tilt_mdocs_batch(progress, tilt_series)
+
+        for half in ("even", "odd"):
+            with _timed(timings, f"prepare_half_stacks ({half})"):
+                prepare_half_stacks(progress, tilt_series, half)
+        with _timed(timings, "prepare_half_stacks (newstack)"):
+            prepare_half_stacks(
+                progress, tilt_series, "even", cmd=str(newstack), overwrite=True
+            )
+
+        with _timed(timings, "aretomo_batch (reconstruct)"):
+            aretomo_batch(
+                progress,
+                tilt_series,
+                label="Reconstructing",
+                reconstruct=True,
+                **aretomo_kwargs,
+            )
+    return timings
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    parser.add_argument("--tilts", type=int, default=41)
+    parser.add_argument(
+        "--aretomo-runtime",
+        type=float,
+        default=0.0,
+        help="seconds each fake aretomo job takes",
+    )
+    parser.add_argument("--dir", type=Path, help="where to generate data")
+    args = parser.parse_args(argv)
+
+    results = {}
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+            results[size] = run_benchmark(
+                tmp, size, n_tilts=args.tilts, aretomo_runtime=args.aretomo_runtime
+            )
+
+    steps = list(next(iter(results.values())))
+    width = max(len(step) for step in steps)
+    print(f"{'step':<{width}}" + "".join(f"{size:>12}" for size in results))
+    for step in steps:
+        row = "".join(f"{timings[step]:>11.2f}s" for timings in results.values())
+        print(f"{step:<{width}}{row}")
+
+
+if __name__ == "__main__":
+    main()
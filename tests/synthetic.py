@@ -0,0 +1,144 @@
+"""Fake Warp data and stand-in executables, to run waretomo without gpus."""
+
+import stat
+import sys
+from pathlib import Path
+
+import mrcfile
+import numpy as np
+
+XML = (
+    '<Movie UnselectManual="{unselect}">'
+    "<OptionsCTF>"
+    '<Param Name="BinTimes" Value="1" />'
+    '<Param Name="Voltage" Value="300" />'
+    '<Param Name="Cs" Value="2.7" />'
+    "</OptionsCTF>"
+    '<CTF><Param Name="Defocus" Value="3.5" /></CTF>'
+    "</Movie>"
+)
+
+FAKE_ARETOMO = """\
+#!{python}
+import os, pathlib, sys, time
+
+args = dict(zip(sys.argv[1::2], sys.argv[2::2]))
+runtime = float(os.environ.get("FAKE_ARETOMO_RUNTIME", {runtime!r}))
+for i in range(5):
+    print(f"Iteration {{i + 1}} of 5", flush=True)
+    time.sleep(runtime / 5)
+out = pathlib.Path(args["-OutMrc"])
+out.write_bytes(bytes({output_size!r}))
+if "-AngFile" in args:
+    # alignment: imod files and alignment parameters, named like aretomo does
+    n_tilts = len(pathlib.Path(args["-AngFile"]).read_text().split())
+    imod_dir = pathlib.Path(out.stem + ".st_Imod")
+    imod_dir.mkdir(exist_ok=True)
+    (imod_dir / (out.stem + ".xf")).write_text("1 0 0 1 0 0\\n" * n_tilts)
+    angles = [-60 + 120 * i / max(n_tilts - 1, 1) for i in range(n_tilts)]
+    tlt = "".join(f"{{a:.2f}}\\n" for a in angles)
+    (imod_dir / (out.stem + ".tlt")).write_text(tlt)
+    pathlib.Path(pathlib.Path(args["-InMrc"]).name + ".aln").write_text("aln")
+"""
+
+FAKE_NEWSTACK = """\
+#!{python}
+import os, pathlib, sys, time
+
+time.sleep(float(os.environ.get("FAKE_NEWSTACK_RUNTIME", {runtime!r})))
+pathlib.Path(sys.argv[-1]).write_bytes(bytes({output_size!r}))
+"""
+
+
+def _write_executable(path, content):
+    path.write_text(content)
+    path.chmod(path.stat().st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return path
+
+
+def make_fake_tools(bin_dir, aretomo_runtime=0.0, newstack_runtime=0.0, output_size=1):
+    """
+    Write fake AreTomo and newstack executables to bin_dir.
+
+    They take the same arguments as the real ones, sleep for the given runtime
+    (seconds; can be overridden with FAKE_ARETOMO_RUNTIME/FAKE_NEWSTACK_RUNTIME)
+    and write output_size bytes wherever their real counterparts write outputs.
+    Returns the paths of the two executables.
+    """
+    bin_dir = Path(bin_dir)
+    bin_dir.mkdir(parents=True, exist_ok=True)
+    aretomo = _write_executable(
+        bin_dir / "AreTomo",
+        FAKE_ARETOMO.format(
+            python=sys.executable, runtime=aretomo_runtime, output_size=output_size
+        ),
+    )
+    newstack = _write_executable(
+        bin_dir / "newstack",
+        FAKE_NEWSTACK.format(
+            python=sys.executable, runtime=newstack_runtime, output_size=output_size
+        ),
+    )
+    return aretomo, newstack
+
+
+def _write_mrc(path, shape, px_size):
+    with mrcfile.new(path, overwrite=True) as mrc:
+        mrc.set_data(np.zeros(shape, dtype=np.float32))
+        mrc.voxel_size = px_size
+
+
+def make_warp_tree(root, n_tilt_series=10, n_tilts=41, size=32, px_size=1.5):
+    """
+    Generate a fake Warp project in root, ready to be processed by waretomo.
+
+    Each tilt series gets an mdoc with its tilts in a dose-symmetric-like order,
+    a movie (empty) and xml per tilt, odd/even averages and an imod stack.
+    The first tilt of each series is deselected, like a tilt excluded by hand.
+    """
+    root = Path(root)
+    for subdir in ("imod", "average/odd", "average/even"):
+        (root / subdir).mkdir(parents=True, exist_ok=True)
+
+    for ts in range(n_tilt_series):
+        name = f"TS_{ts:04d}"
+        lines = [f"PixelSpacing = {px_size}", f"ImageFile = {name}.mrc", ""]
+        angles = []
+        for i in range(n_tilts):
+            angle = -60 + 120 * i / max(n_tilts - 1, 1)
+            z = (i * 7) % n_tilts
+            movie = f"{name}_{z:03d}_{angle:.2f}.tif"
+            lines += [
+                f"[ZValue = {z}]",
+                f"TiltAngle = {angle:.2f}",
+                "ExposureDose = 3.0",
+                f"PixelSpacing = {px_size}",
+                f"SubFramePath = X:\\data\\{movie}",
+                "",
+            ]
+            (root / movie).write_bytes(b"")
+            unselect = i == 0
+            (root / movie).with_suffix(".xml").write_text(
+                XML.format(unselect=str(unselect))
+            )
+            if not unselect:
+                angles.append(angle)
+            for half in ("odd", "even"):
+                average = root / "average" / half / (Path(movie).stem + ".mrc")
+                _write_mrc(average, (size, size), px_size)
+        (root / f"{name}.mdoc").write_text("\n".join(lines))
+
+        imod_dir = root / "imod" / name
+        imod_dir.mkdir(exist_ok=True)
+        _write_mrc(imod_dir / f"{name}.st", (len(angles), size, size), px_size)
+        (imod_dir / f"{name}.rawtlt").write_text(
+            "".join(f"{angle:.2f}\n" for angle in sorted(angles))
+        )
+    return root
+
+
+if __name__ == "__main__":
+    # e.g: python tests/synthetic.py /tmp/warp 10 41
+    make_warp_tree(Path(sys.argv[1]), *map(int, sys.argv[2:]))
+    make_fake_tools(Path(sys.argv[1]) / "bin")
+    print(f"fake executables are in {Path(sys.argv[1]).absolute() / 'bin'}")
@@ -0,0 +1,33 @@
+import os
+
+import pytest
+from benchmark import SIZES, run_benchmark
+
+
+@pytest.mark.parametrize(
+    "n_tilt_series",
+    [
+        10,
+        *(
+            pytest.param(
+                size,
+                marks=pytest.mark.skipif(
+                    not os.environ.get("WARETOMO_BENCHMARK"),
+                    reason="set WARETOMO_BENCHMARK=1 to run large benchmarks",
+                ),
+            )
+            for size in SIZES
+            if size > 10
+        ),
+    ],
+)
+def test_benchmark(tmp_path, n_tilt_series):
+    timings = run_benchmark(tmp_path, n_tilt_series, n_tilts=11)
+    print("\n".join(f"{step}: {t:.2f}s" for step, t in timings.items()))
+
+    output_dir = tmp_path / "output"
+    for i in range(n_tilt_series):
+        name = f"TS_{i:04d}"
+        assert (output_dir / f"{name}.mrc").exists()
+        assert (output_dir / f"{name}_odd.st").exists()
+        assert (tmp_path / "warp" / "mdoc_tilted" / f"{name}.mdoc").exists()
@@ -0,0 +1,86 @@
+import pytest
+
+from waretomo._fix_mdoc import _read_tlt, _remap_angles, _tilt_mdoc
+
+# unsorted, like a dose-symmetric scheme, with a duplicate angle
+ANGLES = [0.0, 3.0, -3.0, 6.0, -6.0, 9.0, -9.0, 3.0]
+SKIPPED = {2, 5}
+# refined by aretomo: sorted, without the skipped tilts
+NEW_ANGLES = [-8.5, -5.5, 0.5, 3.25, 3.5, 6.5]
+
+
+def _write_mdoc(path, angles):
+    lines = ["PixelSpacing = 1.5", "ImageFile = TS_01.mrc", ""]
+    for z, angle in enumerate(angles):
+        lines += [
+            f"[ZValue = {z}]",
+            f"TiltAngle = {angle}",
+            "ExposureDose = 3",
+            "PixelSpacing = 1.5",
+            f"SubFramePath = X:\\data\\TS_01_{z:03d}.tif",
+            "",
+        ]
+    path.write_text("\n".join(lines))
+
+
+def _baseline(mdoc_file, tlt_file, skipped_tilts):
+    """The angles assigned by the original, mdocfile-based implementation."""
+    from mdocfile.data_models import Mdoc
+
+    mdoc = Mdoc.from_file(mdoc_file)
+    new_angles = iter(_read_tlt(tlt_file).tolist())
+    for idx, section in sorted(
+        enumerate(mdoc.section_data), key=lambda x: x[1].TiltAngle
+    ):
+        if idx not in skipped_tilts:
+            section.TiltAngle = next(new_angles)
+    return [(s.ZValue, s.TiltAngle) for s in mdoc.section_data]
+
+
+@pytest.fixture
+def mdoc(tmp_path):
+    mdoc_file = tmp_path / "TS_01.mrc.mdoc"
+    _write_mdoc(mdoc_file, ANGLES)
+    (tmp_path / "mdoc_tilted").mkdir()
+    tlt_file = tmp_path / "TS_01.tlt"
+    tlt_file.write_text("".join(f"{angle}\n" for angle in NEW_ANGLES))
+    return mdoc_file, tlt_file
+
+
+def test_remap_angles():
+    remapped = _remap_angles(ANGLES, NEW_ANGLES, SKIPPED, "TS_01.tlt")
+    # sorted order (stable): 6, 4, 2, 0, 1, 7, 3, 5; minus the skipped 2 and 5
+    assert remapped.tolist() == [0.5, 3.25, -3.0, 6.5, -5.5, 9.0, -8.5, 3.5]
+
+
+@pytest.mark.parametrize("n_new", [len(NEW_ANGLES) - 1, len(NEW_ANGLES) + 1])
+def test_remap_angles_wrong_number(n_new):
+    new_angles = list(range(n_new))
+    with pytest.raises(RuntimeError):
+        _remap_angles(ANGLES, new_angles, SKIPPED, "TS_01.tlt")
+
+
+def test_tilt_mdoc_matches_baseline(mdoc):
+    from mdocfile.data_models import Mdoc
+
+    mdoc_file, tlt_file = mdoc
+    _tilt_mdoc(mdoc_file, tlt_file, ANGLES, SKIPPED)
+    output = mdoc_file.parent / "mdoc_tilted" / mdoc_file.name
+    tilted = Mdoc.from_file(output)
+    assert [(s.ZValue, s.TiltAngle) for s in tilted.section_data] == _baseline(
+        mdoc_file, tlt_file, SKIPPED
+    )
+    # everything but the angles is left untouched
+    original = mdoc_file.read_text().splitlines()
+    rewritten = output.read_text().splitlines()
+    assert len(original) == len(rewritten)
+    for before, after in zip(original, rewritten):
+        if not before.startswith("TiltAngle"):
+            assert before == after
+
+
+def test_tilt_mdoc_corrupted(mdoc):
+    mdoc_file, tlt_file = mdoc
+    # parsed angles don't match the sections in the file anymore
+    with pytest.raises(RuntimeError, match="Mdoc is corrupted: "):
+        _tilt_mdoc(mdoc_file, tlt_file, [*ANGLES, 12.0], SKIPPED | {len(ANGLES)})
@@ -0,0 +1,50 @@
+import subprocess
+import sys
+
+import pytest
+
+# only needed by the steps that use them, and slow to import
+HEAVY = ("torch", "topaz", "pandas", "GPUtil", "mdocfile")
+# modules loaded for `--help`, `--dry-run` and for orchestrating the pipeline
+LIGHT = (
+    "waretomo.main",
+    "waretomo._parse",
+    "waretomo._pipeline",
+    "waretomo._threaded",
+    "waretomo._aretomo",
+    "waretomo._fix_mdoc",
+    "waretomo._stack",
+    "waretomo._topaz",
+    "waretomo._preview",
+)
+# `--help` doesn't even need the io libraries
+HEAVY_FOR_HELP = (*HEAVY, "mrcfile", "numpy", "zarr")
+
+
+def _run(code):
+    return subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    ).stdout
+
+
+@pytest.mark.parametrize("module", LIGHT)
+def test_no_heavy_imports(module):
+    loaded = _run(
+        f"import sys, {module}; " f"print(*[m for m in {HEAVY!r} if m in sys.modules])"
+    ).split()
+    assert not loaded
+
+
+HELP = """
+import contextlib, io, sys
+from waretomo.main import cli
+with contextlib.redirect_stdout(io.StringIO()), contextlib.suppress(SystemExit):
+    cli(["--help"])
+print(*[m for m in {heavy!r} if m in sys.modules])
+"""
+
+
+def test_help_imports():
+    # rather than timing `--help`, which is flaky on a busy machine, check that
+    # none of the slow imports happen
+    assert not _run(HELP.format(heavy=HEAVY_FOR_HELP)).split()
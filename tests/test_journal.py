@@ -0,0 +1,64 @@
+import os
+
+import pytest
+
+from waretomo._cache import check_up_to_date
+from waretomo._journal import Journal
+from waretomo._queue import WorkQueue
+
+
+def test_interrupted_outputs_are_remade(tmp_path):
+    journal = Journal(tmp_path / "journal.jsonl")
+    finished = tmp_path / "finished_aligned.st"
+    interrupted = tmp_path / "interrupted_aligned.st"
+    for output in (finished, interrupted):
+        # written in place, without a manifest
+        output.write_bytes(bytes(10))
+        journal.record("started", output.stem, [output])
+    journal.record("done", finished.stem)
+
+    assert journal.interrupted() == {interrupted.stem: [interrupted]}
+    assert journal.invalidate() == [interrupted.stem]
+    assert journal.interrupted() == {}
+
+    description = {"inputs": {}, "params": {}}
+    with pytest.raises(FileExistsError):
+        check_up_to_date(finished, description)
+    # no exception: needs to be remade
+    check_up_to_date(interrupted, description)
+
+
+def test_resume_removes_outputs(tmp_path):
+    journal = Journal(tmp_path / "journal.jsonl")
+    output = tmp_path / "volume.mrc"
+    output.write_bytes(bytes(10))
+    journal.record("started", "job", [output])
+    assert journal.resume() == ["job"]
+    assert not output.exists()
+    assert journal.interrupted() == {}
+
+
+def test_jobs_running_on_other_workers_are_left_alone(tmp_path):
+    journal = Journal(tmp_path / "journal.jsonl")
+    running = WorkQueue(tmp_path / "queue")
+    joining = WorkQueue(tmp_path / "queue", stale_after=60)
+    try:
+        outputs = {}
+        for key in ("running", "dead", "unclaimed"):
+            outputs[key] = tmp_path / f"{key}_aligned.st"
+            outputs[key].write_bytes(bytes(10))
+        for key in ("running", "dead"):
+            running.claim(key)
+            journal.record("started", key, [outputs[key]])
+        journal.record("started", "unclaimed", [outputs["unclaimed"]])
+        # its worker died a while ago
+        running.release("dead")
+        (tmp_path / "queue" / "dead.claim").write_text("dead")
+        os.utime(tmp_path / "queue" / "dead.claim", (0, 0))
+
+        assert sorted(journal.invalidate(joining)) == ["dead", "unclaimed"]
+        assert journal.resume(joining) == []
+        assert outputs["running"].read_bytes() == bytes(10)
+    finally:
+        running.close()
+        joining.close()
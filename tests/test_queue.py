@@ -0,0 +1,135 @@
+import os
+import time
+
+from rich.progress import Progress
+
+from waretomo._queue import WorkQueue, job_key
+from waretomo._threaded import Job, run_jobs
+
+
+def _worker(root, name, **kwargs):
+    queue = WorkQueue(root, **kwargs)
+    # workers in the same process would otherwise share their owner string
+    queue.owner = name
+    return queue
+
+
+def test_claim(tmp_path):
+    a = _worker(tmp_path, "a")
+    b = _worker(tmp_path, "b")
+    try:
+        assert a.status("job") is None
+        assert a.claim("job") == "new"
+        assert a.status("job") == "mine"
+        assert b.status("job") == "claimed"
+        assert b.claim("job") is None
+        # claiming again is a no-op for the owner
+        assert a.claim("job") == "new"
+    finally:
+        a.close()
+        b.close()
+
+
+def test_finish(tmp_path):
+    a = _worker(tmp_path, "a")
+    b = _worker(tmp_path, "b")
+    try:
+        a.claim("good")
+        a.finish("good")
+        a.claim("bad")
+        a.finish("bad", status="failed")
+        for queue in (a, b):
+            assert queue.status("good") == "done"
+            assert queue.status("bad") == "failed"
+            assert queue.claim("good") is None
+            assert queue.claim("bad") is None
+        assert not list(tmp_path.glob("*.claim"))
+    finally:
+        a.close()
+        b.close()
+
+
+def test_release(tmp_path):
+    a = _worker(tmp_path, "a")
+    b = _worker(tmp_path, "b")
+    try:
+        a.claim("job")
+        a.close()
+        assert b.claim("job") == "new"
+    finally:
+        b.close()
+
+
+def test_heartbeat(tmp_path):
+    a = _worker(tmp_path, "a", heartbeat=0.05, stale_after=0.5)
+    b = _worker(tmp_path, "b", heartbeat=0.05, stale_after=0.5)
+    try:
+        a.claim("job")
+        claim = tmp_path / "job.claim"
+        old = time.time() - 10
+        os.utime(claim, (old, old))
+        time.sleep(0.3)
+        assert claim.stat().st_mtime > old
+        assert b.status("job") == "claimed"
+    finally:
+        a.close()
+        b.close()
+
+
+def test_stale_recovery(tmp_path):
+    a = _worker(tmp_path, "a", stale_after=1)
+    b = _worker(tmp_path, "b", stale_after=1)
+    try:
+        a.claim("job")
+        # a dies: its heartbeat stops, and nobody releases the claim
+        a._stop.set()
+        old = time.time() - 10
+        os.utime(tmp_path / "job.claim", (old, old))
+        assert b.status("job") == "abandoned"
+        assert b.claim("job") == "recovered"
+        assert b.status("job") == "mine"
+        assert (tmp_path / "job.claim").read_text() == "b"
+    finally:
+        b.close()
+
+
+def test_pinned_jobs_stay_on_their_worker(tmp_path):
+    """Results copied back from scratch only exist on the worker which staged them."""
+    root = tmp_path / "queue"
+    a = _worker(root, "a")
+    b = _worker(root, "b")
+    ran = []
+
+    def make_jobs(worker):
+        staged = {}
+
+        def run(gpu):
+            staged["dir"] = worker
+            ran.append(("run", worker))
+            # while this runs, nobody else can take the copy back
+            assert b.status(job_key(copy)) == "claimed"
+
+        def copy_back():
+            assert staged, "copying back results staged by another worker"
+            ran.append(("copy", worker))
+
+        job = Job(run, label="Reconstructing", name="TS_01", gpu=True)
+        copy = Job(
+            copy_back,
+            label="Reconstructing: copying back results",
+            name="TS_01",
+            deps=[job],
+            pinned_to=job,
+        )
+        return [job, copy]
+
+    try:
+        with Progress(disable=True) as progress:
+            state = run_jobs(progress, make_jobs("a"), gpus=[0], queue=a)
+            assert set(state.values()) == {"done"}
+            state = run_jobs(progress, make_jobs("b"), gpus=[0], queue=b)
+            assert set(state.values()) == {"done"}
+    finally:
+        a.close()
+        b.close()
+    assert ran == [("run", "a"), ("copy", "a")]
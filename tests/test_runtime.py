@@ -0,0 +1,34 @@
+from waretomo._gpu import GpuPool
+from waretomo._runtime import predict_makespan
+from waretomo._threaded import Job
+
+
+def _gpu_jobs(n, mem=0):
+    return [Job(None, name=str(i), gpu=True, mem=mem, cost=10) for i in range(n)]
+
+
+def test_one_job_per_gpu():
+    jobs = _gpu_jobs(4)
+    assert predict_makespan(jobs) == 40
+    assert predict_makespan(jobs, gpus=2) == 20
+
+
+def test_gpu_slots():
+    jobs = _gpu_jobs(4)
+    assert predict_makespan(jobs, pool=GpuPool([0], slots=2, memory={})) == 20
+    assert predict_makespan(jobs, pool=GpuPool([0, 1], slots=2, memory={})) == 10
+
+
+def test_packed_by_memory():
+    pool = GpuPool([0], slots=0, memory={0: 10000})
+    # 0.9 * 10000 MB fit 3 jobs at a time
+    assert predict_makespan(_gpu_jobs(6, mem=3000), pool=pool) == 20
+    assert predict_makespan(_gpu_jobs(6, mem=5000), pool=pool) == 60
+    # the pool itself is left untouched
+    assert pool.running == {0: 0}
+
+
+def test_cpu_jobs_dont_take_gpu_slots():
+    gpu = _gpu_jobs(2)
+    cpu = [Job(None, name="cpu", cost=15, deps=[gpu[0]])]
+    assert predict_makespan(gpu + cpu) == 25
@@ -0,0 +1,38 @@
+import threading
+
+import pytest
+
+from waretomo._scratch import Scratch
+
+
+def test_stage_and_cleanup(tmp_path):
+    src = tmp_path / "stack.st"
+    src.write_bytes(bytes(100))
+    scratch = Scratch(tmp_path / "scratch", capacity=1000)
+    try:
+        job_dir = scratch.stage([src, None], output_size=50)
+        assert (job_dir / "stack.st").read_bytes() == bytes(100)
+        assert scratch.used == 150
+        scratch.cleanup(job_dir)
+        assert scratch.used == 0
+        assert not job_dir.exists()
+    finally:
+        scratch.close()
+    assert not scratch.root.exists()
+
+
+def test_waiting_for_space_can_be_cancelled(tmp_path):
+    src = tmp_path / "stack.st"
+    src.write_bytes(bytes(100))
+    scratch = Scratch(tmp_path / "scratch", capacity=150)
+    try:
+        scratch.stage([src])
+        cancelled = threading.Event()
+        timer = threading.Timer(0.1, cancelled.set)
+        timer.start()
+        # there is no space until the first job is cleaned up
+        with pytest.raises(InterruptedError):
+            scratch.stage([src], cancelled=cancelled)
+        timer.join()
+    finally:
+        scratch.close()
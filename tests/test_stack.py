@@ -0,0 +1,67 @@
+import mrcfile
+import numpy as np
+import pytest
+
+from waretomo._stack import _write_stack
+
+PX_SIZE = 2.1
+
+
+@pytest.fixture
+def images(tmp_path):
+    rng = np.random.default_rng(0)
+    paths = []
+    for i in range(5):
+        path = tmp_path / f"tilt_{i}.mrc"
+        with mrcfile.new(path) as mrc:
+            mrc.set_data((rng.normal(size=(30, 40)) * (i + 1) + i).astype(np.float32))
+            mrc.voxel_size = PX_SIZE
+            mrc.header.origin = (1, 2, 3)
+        paths.append(path)
+    return paths
+
+
+def _newstack_header(images):
+    """What newstack writes for these images (an imod image stack)."""
+    data = np.stack([mrcfile.read(img) for img in images])
+    nz, ny, nx = data.shape
+    return {
+        "mode": 2,
+        "ispg": 0,
+        "nx": nx,
+        "ny": ny,
+        "nz": nz,
+        "mx": nx,
+        "my": ny,
+        "mz": nz,
+        "cella": (nx * PX_SIZE, ny * PX_SIZE, nz * PX_SIZE),
+        "origin": (1, 2, 3),
+        "dmin": data.min(),
+        "dmax": data.max(),
+        "dmean": data.mean(dtype=np.float64),
+        "rms": data.std(dtype=np.float64),
+    }, data
+
+
+def test_header_matches_newstack(tmp_path, images):
+    output = tmp_path / "stack.st"
+    _write_stack(images, output)
+    expected, data = _newstack_header(images)
+    with mrcfile.open(output) as mrc:
+        np.testing.assert_array_equal(mrc.data, data)
+        header = mrc.header
+        for field in ("mode", "ispg", "nx", "ny", "nz", "mx", "my", "mz"):
+            assert header[field] == expected[field], field
+        np.testing.assert_allclose(header.cella.tolist(), expected["cella"])
+        np.testing.assert_allclose(header.origin.tolist(), expected["origin"])
+        for field in ("dmin", "dmax", "dmean", "rms"):
+            np.testing.assert_allclose(header[field], expected[field], rtol=1e-5)
+        assert mrc.is_image_stack()
+        np.testing.assert_allclose(mrc.voxel_size.tolist(), [PX_SIZE] * 3, rtol=1e-6)
+
+
+def test_mismatched_shapes(tmp_path, images):
+    with mrcfile.new(images[-1], overwrite=True) as mrc:
+        mrc.set_data(np.zeros((10, 10), dtype=np.float32))
+    with pytest.raises(ValueError):
+        _write_stack(images, tmp_path / "stack.st")
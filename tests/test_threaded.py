@@ -0,0 +1,145 @@
+import asyncio
+import signal
+import subprocess
+import sys
+import time
+
+import pytest
+from rich.progress import Progress
+
+from waretomo._gpu import QUARANTINE_AFTER
+from waretomo._threaded import Job, _blames_gpu, run_jobs, run_streamed
+
+
+def _run(jobs, **kwargs):
+    with Progress(disable=True) as progress:
+        return run_jobs(progress, jobs, **kwargs)
+
+
+def _fail():
+    raise OSError("broken input")
+
+
+def test_upstream_failure_reaches_costlier_jobs():
+    # c is looked at first (highest cost), before b is skipped
+    a = Job(_fail, name="a")
+    b = Job(lambda: None, name="b", deps=[a])
+    c = Job(lambda: None, name="c", deps=[b], cost=10)
+    state = _run([a, b, c])
+    assert state == {a: "failed", b: "failed", c: "failed"}
+
+
+def test_exception_only_fails_its_job():
+    ran = []
+
+    def bad_mdoc():
+        raise RuntimeError("Mdoc is corrupted")
+
+    def slow():
+        time.sleep(0.3)
+        ran.append("slow")
+
+    bad = Job(bad_mdoc, name="bad")
+    after_bad = Job(lambda: ran.append("after bad"), name="after bad", deps=[bad])
+    other = Job(slow, name="other")
+    after_other = Job(lambda: ran.append("after other"), name="after", deps=[other])
+    state = _run([bad, after_bad, other, after_other])
+    assert state[bad] == state[after_bad] == "failed"
+    assert state[other] == state[after_other] == "done"
+    assert ran == ["slow", "after other"]
+
+
+def _gpu_job(name, fn, cost=0):
+    async def run(gpu):
+        return await fn(gpu)
+
+    return Job(run, name=name, gpu=True, cost=cost)
+
+
+def _sleep_then(duration, fail_on=(), returncode=1, attempts=None):
+    async def fn(gpu):
+        if attempts is not None:
+            attempts.append(gpu)
+        await asyncio.sleep(duration)
+        if gpu in fail_on:
+            raise subprocess.CalledProcessError(returncode, ["AreTomo"])
+
+    return fn
+
+
+def test_retry_on_same_gpu():
+    attempts = []
+
+    async def flaky(gpu):
+        attempts.append(gpu)
+        if len(attempts) < 3:
+            raise subprocess.CalledProcessError(1, ["AreTomo"])
+
+    job = _gpu_job("flaky", flaky)
+    assert _run([job], gpus=[0], retries=2) == {job: "done"}
+    assert attempts == [0, 0, 0]
+    attempts.clear()
+    assert _run([job], gpus=[0], retries=1) == {job: "failed"}
+
+
+def test_failover_to_another_gpu():
+    attempts = []
+    job = _gpu_job("job", _sleep_then(0, fail_on={0}, attempts=attempts))
+    assert _run([job], gpus=[0, 1], retries=1) == {job: "done"}
+    assert attempts == [0, 1]
+
+
+def test_broken_gpu_is_quarantined():
+    attempts = []
+    fn = _sleep_then(0.02, fail_on={0}, attempts=attempts)
+    jobs = [_gpu_job(str(i), fn) for i in range(12)]
+    state = _run(jobs, gpus=[0, 1], retries=1)
+    assert set(state.values()) == {"done"}
+    # each job fails on gpu 0 at most once, and it stops being used after a few
+    assert attempts.count(1) == len(jobs)
+    assert QUARANTINE_AFTER <= attempts.count(0) < len(jobs) / 2
+
+
+@pytest.mark.parametrize("retries", [0, 1])
+def test_bad_inputs_dont_quarantine_gpus(retries):
+    # failing everywhere is the job's fault, not the gpus'
+    attempts = []
+    bad = [
+        _gpu_job(f"bad {i}", _sleep_then(0, fail_on={0, 1}), cost=1) for i in range(6)
+    ]
+    good = [
+        _gpu_job(f"good {i}", _sleep_then(0.05, attempts=attempts)) for i in range(8)
+    ]
+    state = _run(bad + good, gpus=[0, 1], retries=retries)
+    assert [state[job] for job in bad] == ["failed"] * len(bad)
+    assert [state[job] for job in good] == ["done"] * len(good)
+    assert set(attempts) == {0, 1}
+
+
+@pytest.mark.parametrize(
+    "err, blamed",
+    [
+        (subprocess.CalledProcessError(1, ["AreTomo"]), False),
+        (subprocess.CalledProcessError(-signal.SIGKILL, ["AreTomo"]), True),
+        (subprocess.TimeoutExpired(["AreTomo"], 1), True),
+    ],
+)
+def test_blames_gpu(err, blamed):
+    assert _blames_gpu(err) == blamed
+
+
+def test_timeout_kills_and_fails_over():
+    attempts = []
+
+    async def hangs_on_gpu_0(gpu):
+        attempts.append(gpu)
+        code = "import time; time.sleep(30)" if gpu == 0 else "pass"
+        await run_streamed([sys.executable, "-c", code], timeout=0.5)
+
+    job = _gpu_job("job", hangs_on_gpu_0)
+    start = time.monotonic()
+    assert _run([job], gpus=[0], retries=0) == {job: "failed"}
+    assert time.monotonic() - start < 10
+    attempts.clear()
+    assert _run([job], gpus=[0, 1], retries=1) == {job: "done"}
+    assert attempts == [0, 1]
@@ -0,0 +1,116 @@
+import queue
+import sys
+
+import mrcfile
+import numpy as np
+import pytest
+
+import waretomo._topaz
+from waretomo._topaz import (
+    _denoise_worker,
+    _downsample,
+    _output_path,
+    _read_volume,
+    _write_volume,
+)
+
+pytest.importorskip("topaz")
+
+
+def _write_tomo(path, shape=(8, 16, 16)):
+    with mrcfile.new(path) as mrc:
+        mrc.set_data(np.random.default_rng(0).normal(size=shape).astype(np.float32))
+        mrc.voxel_size = 10
+    return path
+
+
+@pytest.fixture
+def model(tmp_path):
+    """An untrained model, saved like a trained one."""
+    import torch
+    from topaz.denoise import UDenoiseNet3D
+
+    path = tmp_path / "model.sav"
+    torch.save(UDenoiseNet3D(base_width=11).state_dict(), path)
+    return str(path)
+
+
+def test_worker_survives_failing_tomogram(tmp_path, monkeypatch, model):
+    def denoise(model, tomo, patch_size, update=None):
+        if tomo.shape[0] == 3:
+            raise ValueError("odd shape")
+        return tomo
+
+    monkeypatch.setattr(waretomo._topaz, "_denoise_volume", denoise)
+    # the worker silences its output, as it normally runs in its own process
+    monkeypatch.setattr(sys, "stdout", sys.stdout)
+    monkeypatch.setattr(sys, "stderr", sys.stderr)
+    outdir = tmp_path / "denoised"
+    outdir.mkdir()
+    paths = [
+        _write_tomo(tmp_path / "a.mrc"),
+        _write_tomo(tmp_path / "odd.mrc", shape=(3, 16, 16)),
+        _write_tomo(tmp_path / "b.mrc"),
+    ]
+    todo, results = queue.Queue(), queue.Queue()
+    for item in (*paths, None):
+        todo.put(item)
+
+    _denoise_worker(model, -1, 1, outdir, 32, 1, "mrc", todo, results)
+    sys.stdout.close()
+    events = {}
+    while not results.empty():
+        path, kind, _ = results.get()
+        events[path.name] = kind
+    assert events == {"a.mrc": "done", "odd.mrc": "error", "b.mrc": "done"}
+    assert sorted(p.name for p in outdir.iterdir()) == ["a.mrc", "b.mrc"]
+
+
+def test_write_float16(tmp_path):
+    path = _write_tomo(tmp_path / "tomo.mrc")
+    volume, header, extended_header = _read_volume(path)
+    output = tmp_path / "denoised.mrc"
+    _write_volume(output, volume, header, extended_header, "mrc-float16")
+    with mrcfile.open(output) as mrc:
+        assert mrc.header.mode == 12
+        assert mrc.data.dtype == np.float16
+        np.testing.assert_allclose(mrc.data, volume, rtol=1e-3, atol=1e-3)
+        np.testing.assert_allclose(mrc.voxel_size.tolist(), [10] * 3)
+        assert mrc.header.dmin == mrc.data.min()
+        assert mrc.header.dmax == mrc.data.max()
+    assert output.stat().st_size < path.stat().st_size * 0.6
+
+
+def test_write_ome_zarr(tmp_path):
+    zarr = pytest.importorskip("zarr")
+    path = tmp_path / "tomo.mrc"
+    with mrcfile.new(path) as mrc:
+        mrc.set_data(
+            np.random.default_rng(0).normal(size=(40, 130, 100)).astype(np.float32)
+        )
+        mrc.voxel_size = (12, 11, 10)  # x, y, z
+    volume, header, extended_header = _read_volume(path)
+    output = _output_path(tmp_path, path, "ome-zarr")
+    _write_volume(output, volume, header, extended_header, "ome-zarr")
+
+    root = zarr.open_group(str(output), mode="r")
+    (multiscales,) = root.attrs["multiscales"]
+    assert multiscales["version"] == "0.4"
+    assert [axis["name"] for axis in multiscales["axes"]] == ["z", "y", "x"]
+    datasets = multiscales["datasets"]
+    assert [dataset["path"] for dataset in datasets] == ["0", "1", "2"]
+    scale, *translation = datasets[0]["coordinateTransformations"]
+    assert scale == {"type": "scale", "scale": [10, 11, 12]}
+    assert not translation
+    for binning, dataset in zip((2, 4), datasets[1:]):
+        scale, translation = dataset["coordinateTransformations"]
+        assert scale["scale"] == [10 * binning, 11 * binning, 12 * binning]
+        # the first binned voxel is centered on the middle of those it bins
+        assert translation == {
+            "type": "translation",
+            "translation": [s * (binning - 1) / 2 for s in (10, 11, 12)],
+        }
+    np.testing.assert_array_equal(root["0"][:], volume)
+    assert root["1"].shape == (20, 65, 50)
+    np.testing.assert_allclose(root["1"][:], _downsample(volume))
+    assert root["2"].shape == (10, 32, 25)
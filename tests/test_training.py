@@ -0,0 +1,109 @@
+import mrcfile
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+
+from waretomo._training import TEST_FRACTION, HalfTomogramPatches
+
+SHAPE = (20, 24, 60)
+TILE = 8
+
+
+def _write_half(path, data):
+    path.parent.mkdir(exist_ok=True)
+    with mrcfile.new(path) as mrc:
+        mrc.set_data(data.astype(np.float32))
+
+
+def _write_halves(root, shape=SHAPE):
+    rng = np.random.default_rng(0)
+    for name in ("TS_01", "TS_02", "TS_03"):
+        even = rng.normal(size=shape)
+        _write_half(root / "even" / f"{name}.mrc", even)
+        if name != "TS_03":
+            # the same up to a linear transform, so both are equal once normalized
+            _write_half(root / "odd" / f"{name}.mrc", even * 3 + 1)
+    return root / "even", root / "odd"
+
+
+@pytest.fixture
+def halves(tmp_path):
+    return _write_halves(tmp_path)
+
+
+def test_pairs(halves):
+    data = HalfTomogramPatches(*halves, TILE, n_train=20, n_test=5)
+    assert [(e.name, o.name) for e, o in data.pairs] == [
+        ("TS_01.mrc", "TS_01.mrc"),
+        ("TS_02.mrc", "TS_02.mrc"),
+    ]
+    for mode, n in (("train", 20), ("test", 5)):
+        data.set_mode(mode)
+        assert len(data) == n * 2
+        for source, target in data:
+            assert source.shape == target.shape == (1, TILE, TILE, TILE)
+            # tiles of a pair come from the same place, with the same augmentation
+            np.testing.assert_allclose(source, target, atol=1e-4)
+
+
+def test_held_out_strip(halves):
+    data = HalfTomogramPatches(*halves, TILE, n_train=200, n_test=50)
+    nx = SHAPE[2]
+    test_start = nx - max(TILE, round(nx * TEST_FRACTION))
+    for train, test in zip(data.coords["train"], data.coords["test"]):
+        assert (train[:, 2] + TILE <= test_start).all()
+        assert (test[:, 2] >= test_start).all()
+        assert (test[:, 2] + TILE <= nx).all()
+        for coords in (train, test):
+            assert (coords >= 0).all()
+            assert (coords[:, :2] + TILE <= SHAPE[:2]).all()
+
+
+def test_max_mapped(halves):
+    size = np.zeros(SHAPE, dtype=np.float32).nbytes * 2
+    data = HalfTomogramPatches(*halves, TILE, n_train=5, n_test=1, max_mapped=size)
+    for _ in data:
+        assert len(data._maps) == 1
+
+
+def test_unusable_halves(tmp_path):
+    _write_half(tmp_path / "even" / "small.mrc", np.zeros((4, 24, 60)))
+    _write_half(tmp_path / "odd" / "small.mrc", np.zeros((4, 24, 60)))
+    _write_half(tmp_path / "even" / "mismatch.mrc", np.zeros(SHAPE))
+    _write_half(tmp_path / "odd" / "mismatch.mrc", np.zeros((20, 24, 50)))
+    with pytest.raises(RuntimeError, match="no usable half tomograms"):
+        HalfTomogramPatches(tmp_path / "even", tmp_path / "odd", TILE, 5, 1)
+
+
+def test_train_model(tmp_path):
+    pytest.importorskip("topaz")
+    import torch
+
+    from waretomo._topaz import _train_model
+
+    # the smallest tiles the network can take
+    halves = _write_halves(tmp_path, shape=(32, 32, 72))
+    updates = []
+    model = _train_model(
+        *(str(half) for half in halves),
+        save_prefix=str(tmp_path / "models" / "model"),
+        device=-1,
+        tile_size=32,
+        update=lambda **kwargs: updates.append(kwargs),
+        num_epochs=2,
+        save_interval=1,
+        minibatch_size=2,
+        n_train=2,
+        n_test=1,
+        num_workers=0,
+    )
+    assert sorted(p.name for p in (tmp_path / "models").iterdir()) == [
+        "model_epoch1.sav",
+        "model_epoch2.sav",
+    ]
+    # 2 epochs of 2 pairs * 2 tiles, in minibatches of 2
+    assert [u["completed"] for u in updates] == [0.5, 1, 1.5, 2]
+    assert all(u["total"] == 2 for u in updates)
+    with torch.no_grad():
+        assert model.eval()(torch.zeros(1, 1, 32, 32, 32)).shape == (1, 1, 32, 32, 32)
@@ -0,0 +1,54 @@
+from synthetic import make_warp_tree
+
+import waretomo._parse
+import waretomo._watch
+from waretomo._watch import watch_data
+
+
+def test_watch_skips_broken_mdocs(tmp_path, monkeypatch):
+    monkeypatch.setattr(waretomo._watch, "MIN_INTERVAL", 0)
+    parsed = []
+    parse = waretomo._parse._parse_tilt_series
+
+    def spy(mdoc_file, *args, **kwargs):
+        parsed.append(mdoc_file.stem)
+        return parse(mdoc_file, *args, **kwargs)
+
+    monkeypatch.setattr(waretomo._parse, "_parse_tilt_series", spy)
+
+    warp_dir = make_warp_tree(tmp_path / "warp", n_tilt_series=4, n_tilts=5)
+    output_dir = tmp_path / "output"
+    output_dir.mkdir()
+    later = {}
+    for name in ("TS_0002", "TS_0003"):
+        mdoc = warp_dir / f"{name}.mdoc"
+        later[name] = mdoc.read_text()
+        mdoc.unlink()
+
+    new = watch_data(
+        warp_dir,
+        warp_dir,
+        interval=0.1,
+        settle=0,
+        output_dir=output_dir,
+        roi_dir=None,
+        cache_file=output_dir / "waretomo_cache.json",
+    )
+    try:
+        assert [ts["name"] for ts in next(new)] == ["TS_0000", "TS_0001"]
+
+        # still being written by serialem
+        half = later["TS_0002"]
+        (warp_dir / "TS_0002.mdoc").write_text(half[: half.index("TiltAngle") + 12])
+        (warp_dir / "TS_0003.mdoc").write_text(later["TS_0003"])
+        parsed.clear()
+        assert [ts["name"] for ts in next(new)] == ["TS_0003"]
+        # tilt series which were already found are not parsed again
+        assert sorted(parsed) == ["TS_0002", "TS_0003"]
+
+        (warp_dir / "TS_0002.mdoc").write_text(later["TS_0002"])
+        parsed.clear()
+        assert [ts["name"] for ts in next(new)] == ["TS_0002"]
+        assert set(parsed) == {"TS_0002"}
+    finally:
+        new.close()